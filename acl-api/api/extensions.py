@@ -8,14 +8,14 @@ from flask_caching import Cache
 from flask_cors import CORS
 from flask_login import LoginManager
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 
+from api.lib.db_session import RoutingSQLAlchemy
 from api.lib.utils import RedisHandler
 
 bcrypt = Bcrypt()
 babel = Babel()
 login_manager = LoginManager()
-db = SQLAlchemy(session_options={"autoflush": False})
+db = RoutingSQLAlchemy(session_options={"autoflush": False})
 migrate = Migrate()
 cache = Cache()
 celery = Celery()
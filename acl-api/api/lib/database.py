@@ -9,19 +9,32 @@ from api.lib.exception import CommitException
 
 
 class FormatMixin(object):
-    def to_dict(self):
-        res = dict()
-        for k in getattr(self, "__mapper__").c.keys():
-            if k in {'password', '_password', 'secret', '_secret'}:
-                continue
+    _HIDDEN_COLUMNS = {'password', '_password', 'secret', '_secret'}
 
-            if k.startswith('_'):
-                k = k[1:]
+    @classmethod
+    def get_column_meta(cls):
+        """
+        per-model column metadata, computed once from the mapper
+        :return: ({column key: 1}, [(column key, is temporal), ], to_dict fields [(attribute, is temporal), ])
+        """
+        meta = cls.__dict__.get("_column_meta")
+        if meta is None:
+            from sqlalchemy.sql.sqltypes import Time, Date, DateTime
+
+            columns = [(k, isinstance(c.type, (Time, Date, DateTime)))
+                       for k, c in getattr(cls, "__mapper__").c.items()]
+            fields = [(k[1:] if k.startswith('_') else k, is_temporal)
+                      for k, is_temporal in columns if k not in cls._HIDDEN_COLUMNS]
+            meta = ({k: 1 for k, _ in columns}, columns, fields)
+            setattr(cls, "_column_meta", meta)
+
+        return meta
 
-            if not isinstance(getattr(self, k), (datetime.datetime, datetime.date, datetime.time)):
-                res[k] = getattr(self, k)
-            else:
-                res[k] = str(getattr(self, k))
+    def to_dict(self):
+        res = dict()
+        for k, is_temporal in self.get_column_meta()[2]:
+            value = getattr(self, k)
+            res[k] = str(value) if is_temporal and value is not None else value
 
         return res
 
@@ -44,7 +57,7 @@ class FormatMixin(object):
 
     @classmethod
     def get_columns(cls):
-        return {k: 1 for k in getattr(cls, "__mapper__").c.keys()}
+        return dict(cls.get_column_meta()[0])
 
 
 class CRUDMixin(FormatMixin):
@@ -89,6 +102,61 @@ class CRUDMixin(FormatMixin):
         setattr(self, "deleted_at", datetime.datetime.now())
         self.save(flush=flush, commit=commit)
 
+    @staticmethod
+    def _commit(flush=False, commit=True):
+        try:
+            if flush:
+                db.session.flush()
+            elif commit:
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise CommitException(str(e))
+
+    @classmethod
+    def bulk_create(cls, rows, flush=False, commit=True, with_ids=False):
+        """
+        one multi-row INSERT through Core, the rows must share the same keys
+        with_ids goes through the ORM instead, MySQL has no RETURNING so that is one INSERT per row
+        :param rows: [{column: value}, ]
+        :return: the created objects when with_ids, else the number of inserted rows
+        with commit=False the pending work is committed by the next committing call
+        """
+        if with_ids:
+            objs = [cls(**row) for row in rows]
+            objs and db.session.add_all(objs)
+            cls._commit(flush=flush, commit=commit)
+
+            return objs
+
+        try:
+            rows and db.session.execute(getattr(cls, "__table__").insert(), rows, mapper=getattr(cls, "__mapper__"))
+        except Exception as e:
+            db.session.rollback()
+            raise CommitException(str(e))
+        cls._commit(flush=flush, commit=commit)
+
+        return len(rows)
+
+    @classmethod
+    def bulk_update(cls, ids, flush=False, commit=True, **kwargs):
+        """
+        UPDATE ... WHERE pk IN (ids)
+        :return: the number of updated rows
+        """
+        ids = list(ids)
+        count = 0
+        if ids:
+            pk = getattr(cls, "__mapper__").primary_key[0]
+            count = getattr(cls, "query").filter(pk.in_(ids)).update(kwargs, synchronize_session=False)
+        cls._commit(flush=flush, commit=commit)
+
+        return count
+
+    @classmethod
+    def bulk_soft_delete(cls, ids, flush=False, commit=True):
+        return cls.bulk_update(ids, flush=flush, commit=commit, deleted=True, deleted_at=datetime.datetime.now())
+
     @classmethod
     def get_by_id(cls, _id):
         if any((isinstance(_id, six.string_types) and _id.isdigit(),
@@ -105,12 +173,23 @@ class CRUDMixin(FormatMixin):
                deleted=False,
                use_master=False,
                only_query=False,
+               to_tuple=False,
                **kwargs):
-        db_session = db.session if not use_master else db.session().using_bind("master")
+        """
+        :param use_master: read from the primary, a query returned by only_query is not pinned
+        :param to_tuple: with fl, return plain tuples (bare values for a single field) read straight
+        from the result set, skipping ORM row processing
+        """
+        if use_master:
+            with db.session().using_bind("master"):
+                return cls.get_by(first=first, to_dict=to_dict, fl=fl, exclude=exclude, deleted=deleted,
+                                  only_query=only_query, to_tuple=to_tuple, **kwargs)
+
+        db_session = db.session
         fl = fl.strip().split(",") if fl and isinstance(fl, six.string_types) else (fl or [])
         exclude = exclude.strip().split(",") if exclude and isinstance(exclude, six.string_types) else (exclude or [])
 
-        keys = cls.get_columns()
+        keys = cls.get_column_meta()[0]
         fl = [k for k in fl if k in keys]
         fl = [k for k in keys if k not in exclude and not k.isupper()] if exclude else fl
         fl = list(filter(lambda x: "." not in x, fl))
@@ -134,7 +213,10 @@ class CRUDMixin(FormatMixin):
         if only_query:
             return query
 
-        if fl:
+        if fl and to_tuple:
+            rows = db_session.execute(query.statement, mapper=getattr(cls, "__mapper__"))
+            result = [i[0] for i in rows] if len(fl) == 1 else [tuple(i) for i in rows]
+        elif fl:
             result = [{k: getattr(i, k) for k in fl} if to_dict else i for i in query]
         else:
             result = [i.to_dict() if to_dict else i for i in query]
@@ -0,0 +1,150 @@
+# -*- coding:utf-8 -*-
+
+"""
+read replica routing, configured by SQLALCHEMY_REPLICAS
+
+plain SELECTs go to a healthy replica of the bind the model lives on, everything else (flushes,
+bulk updates, raw statements, SELECT ... FOR UPDATE, inside using_bind("master")) goes to the primary
+after a write a session keeps reading from the primary for max_lag seconds so it sees its own writes
+
+reads whose result outlives the request (cache fills, rebuilds) or decides a write must run under
+use_master: another process may have just written, and a lagging replica would cache the old state
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask_sqlalchemy import SignallingSession
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy import text
+from sqlalchemy.sql.selectable import Select
+
+
+_pinned = threading.local()
+
+
+@contextmanager
+def primary():
+    """
+    route every query of the current thread to the primary
+    """
+    _pinned.depth = getattr(_pinned, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _pinned.depth -= 1
+
+
+def use_master(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        _pinned.depth = getattr(_pinned, "depth", 0) + 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _pinned.depth -= 1
+
+    return wrapper
+
+
+class ReplicaMonitor(object):
+    """
+    per-process replica health, a replica is skipped while unreachable or lagging more than max_lag
+    """
+    _checked = dict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _lag(engine):
+        with engine.connect() as conn:
+            result = conn.execute(text("SHOW SLAVE STATUS"))
+            keys = list(result.keys())
+            row = result.first()
+
+        if row is None:  # not replicating as seen from here, its data cannot be trusted to be current
+            return
+
+        status = dict(zip(keys, row))
+
+        return status.get("Seconds_Behind_Master", status.get("Seconds_Behind_Source"))
+
+    @classmethod
+    def is_healthy(cls, app, name, engine, config):
+        healthy, checked_at = cls._checked.get(name, (False, 0))
+        if checked_at + config.get("check_interval", 5) > time.time() or not cls._lock.acquire(False):
+            return healthy
+
+        try:
+            lag = cls._lag(engine)
+            healthy = lag is not None and lag <= config.get("max_lag", 2)
+            healthy or app.logger.warning("replica {0} skipped, lag: {1}".format(name, lag))
+        except Exception as e:
+            healthy = False
+            app.logger.warning("replica {0} skipped: {1}".format(name, e))
+        finally:
+            cls._checked[name] = (healthy, time.time())
+            cls._lock.release()
+
+        return healthy
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, *args, **kwargs):
+        self._db = db
+        self._name = None
+        self._primary_until = 0
+
+        super(RoutingSession, self).__init__(db, *args, **kwargs)
+
+    @contextmanager
+    def using_bind(self, name):
+        """
+        pin this session to a bind inside the block, "master" for the primary
+        """
+        origin, self._name = self._name, name
+        try:
+            yield self
+        finally:
+            self._name = origin
+
+    @staticmethod
+    def _bind_key(mapper):
+        table = getattr(mapper, "persist_selectable", None)
+
+        return getattr(table, "info", {}).get("bind_key")
+
+    def _get_replica(self, bind_key):
+        config = self.app.config.get("SQLALCHEMY_REPLICAS") or {}
+        names = list((config.get("binds") or {}).get(bind_key) or [])
+        random.shuffle(names)
+
+        for name in names:
+            engine = self._db.get_engine(self.app, bind=name)
+            if ReplicaMonitor.is_healthy(self.app, name, engine, config):
+                return engine
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._name is not None and self._name != "master":
+            return self._db.get_engine(self.app, bind=self._name)
+
+        is_read = (isinstance(clause, Select) and getattr(clause, "_for_update_arg", None) is None and
+                   not self._flushing)
+        if not is_read:
+            config = self.app.config.get("SQLALCHEMY_REPLICAS") or {}
+            self._primary_until = time.time() + config.get("max_lag", 2)
+
+        elif self._name is None and not getattr(_pinned, "depth", 0) and self._primary_until < time.time():
+            engine = self._get_replica(self._bind_key(mapper))
+            if engine is not None:
+                return engine
+
+        return super(RoutingSession, self).get_bind(mapper, clause, **kwargs)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
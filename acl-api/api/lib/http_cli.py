@@ -2,12 +2,19 @@
 
 
 import hashlib
+import os
 
 import requests
 from flask import abort
 from flask import current_app
 from flask_login import current_user
 from future.moves.urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# the remote ACL calls are token lookups, safe to send again; urllib3 < 1.26 names the argument method_whitelist
+RETRY_METHODS = frozenset(["HEAD", "GET", "PUT", "DELETE", "OPTIONS", "TRACE", "POST"])
+_RETRY_METHODS_ARG = "allowed_methods" if hasattr(Retry, "DEFAULT_ALLOWED_METHODS") else "method_whitelist"
 
 
 def build_api_key(path, params):
@@ -46,3 +53,48 @@ def api_request(url, method="get", params=None, ret_key=None):
         current_app.logger.warning(params)
         current_app.logger.error(str(e))
         return abort(500, "server unknown error")
+
+
+class HttpClient(object):
+    """
+    per-process requests.Session with keep-alive pooling, bounded retries and a default timeout
+    configured by ACL_HTTP
+    """
+    _session = None
+    _pid = None
+
+    @staticmethod
+    def _config():
+        return current_app.config.get("ACL_HTTP") or {}
+
+    @classmethod
+    def session(cls):
+        if cls._session is None or cls._pid != os.getpid():
+            config = cls._config()
+            retry = Retry(total=config.get("retries", 2),
+                          backoff_factor=config.get("backoff_factor", 0.1),
+                          status_forcelist=(502, 503, 504),
+                          **{_RETRY_METHODS_ARG: RETRY_METHODS})
+            adapter = HTTPAdapter(pool_connections=config.get("pool_connections", 10),
+                                  pool_maxsize=config.get("pool_maxsize", 20),
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            cls._session, cls._pid = session, os.getpid()
+
+        return cls._session
+
+    @classmethod
+    def request(cls, method, url, **kwargs):
+        kwargs.setdefault("timeout", tuple(cls._config().get("timeout", (3, 10))))
+
+        return cls.session().request(method, url, **kwargs)
+
+    @classmethod
+    def get(cls, url, **kwargs):
+        return cls.request("GET", url, **kwargs)
+
+    @classmethod
+    def post(cls, url, **kwargs):
+        return cls.request("POST", url, **kwargs)
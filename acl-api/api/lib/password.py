@@ -0,0 +1,147 @@
+# -*- coding:utf-8 -*-
+
+"""
+passwords are stored as a hash of their md5 digest, so clients posting either the clear password
+or its md5 (what the web frontend sends) keep working whatever the configured hasher is
+
+PASSWORD_HASHER selects the hasher used for new hashes, hashes in a weaker format are
+upgraded on the next successful login
+"""
+
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from api.extensions import bcrypt
+
+
+class MD5Hasher(object):
+    """
+    legacy format: the bare md5 digest, also the fallback for values no other hasher recognises
+    """
+    name = "md5"
+    strength = 0
+
+    @staticmethod
+    def identify(encoded):
+        return not encoded.startswith("$")
+
+    @staticmethod
+    def encode(digest):
+        return digest
+
+    @staticmethod
+    def verify(encoded, digest):
+        return encoded == digest
+
+
+class BcryptHasher(object):
+    name = "bcrypt"
+    strength = 1
+
+    @staticmethod
+    def identify(encoded):
+        return encoded.startswith(("$2a$", "$2b$", "$2y$"))
+
+    @staticmethod
+    def encode(digest):
+        return bcrypt.generate_password_hash(digest).decode("utf-8")
+
+    @staticmethod
+    def verify(encoded, digest):
+        return bcrypt.check_password_hash(encoded, digest)
+
+
+HASHERS = {i.name: i for i in (MD5Hasher, BcryptHasher)}
+
+_MD5_DIGEST = re.compile(r"^[0-9a-f]{32}$")
+
+
+class VerifyCache(object):
+    """
+    bounded, short-lived results of slow hash verifications, keyed by the stored hash and the candidate
+    a password change replaces the stored hash, so its old entries can never match again
+    """
+    _data = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _config():
+        return current_app.config.get("PASSWORD_VERIFY_CACHE") or {}
+
+    @staticmethod
+    def _key(encoded, candidate):
+        return hashlib.sha256("{0}\n{1}".format(encoded, candidate).encode("utf-8")).digest()
+
+    @classmethod
+    def get(cls, encoded, candidate):
+        key = cls._key(encoded, candidate)
+        with cls._lock:
+            item = cls._data.get(key)
+            if item is not None and item[1] > time.time():
+                return item[0]
+
+            cls._data.pop(key, None)
+
+    @classmethod
+    def set(cls, encoded, candidate, result):
+        config = cls._config()
+        if not config.get("maxsize", 10000):
+            return
+
+        with cls._lock:
+            cls._data[cls._key(encoded, candidate)] = (result, time.time() + config.get("ttl", 60))
+            while len(cls._data) > config.get("maxsize", 10000):
+                cls._data.popitem(last=False)
+
+
+def get_hasher():
+    return HASHERS[current_app.config.get("PASSWORD_HASHER") or MD5Hasher.name]
+
+
+def _identify(encoded):
+    for hasher in HASHERS.values():
+        if hasher is not MD5Hasher and hasher.identify(encoded):
+            return hasher
+
+    return MD5Hasher
+
+
+def make_password(password):
+    return get_hasher().encode(hashlib.md5(password.encode('utf-8')).hexdigest())
+
+
+def _candidates(hasher, password):
+    """
+    digests the stored hash may have been made from, a slow hasher only gets the likely one
+    """
+    digest = hashlib.md5(password.encode('utf-8')).hexdigest()
+    if hasher is MD5Hasher:
+        return password, digest
+
+    return (password if _MD5_DIGEST.match(password) else digest),
+
+
+def check_password(encoded, password):
+    """
+    :return: (matched, new encoded value when the stored hash should be upgraded, else None)
+    """
+    hasher = encoded and _identify(encoded)
+    if not hasher:
+        return False, None
+
+    for digest in _candidates(hasher, password):
+        matched = VerifyCache.get(encoded, digest)
+        if matched is None:
+            matched = hasher.verify(encoded, digest)
+            hasher is not MD5Hasher and VerifyCache.set(encoded, digest, matched)
+
+        if matched:
+            target = get_hasher()
+            return True, (target.encode(digest) if target.strength > hasher.strength else None)
+
+    return False, None
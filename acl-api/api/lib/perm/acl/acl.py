@@ -3,16 +3,18 @@
 import functools
 import hashlib
 
-import requests
 import six
 from flask import abort
 from flask import current_app
+from flask import g
 from flask import request
 from flask import session
 from flask_login import current_user
 
 from api.extensions import cache
+from api.lib.http_cli import HttpClient
 from api.lib.perm.acl.audit import AuditCRUD
+from api.lib.perm.acl.cache import AppAdminRoleCache
 from api.lib.perm.acl.cache import AppCache
 from api.lib.perm.acl.cache import RoleCache
 from api.lib.perm.acl.cache import UserCache
@@ -33,7 +35,7 @@ def get_access_token():
     payload = dict(app_id=current_app.config.get('APP_ID'),
                    secret_key=hashlib.md5(current_app.config.get('APP_SECRET_KEY').encode('utf-8')).hexdigest())
     try:
-        res = requests.post(url, data=payload).json()
+        res = HttpClient.post(url, data=payload).json()
         return res.get("token")
     except Exception as e:
         current_app.logger.error(str(e))
@@ -205,13 +207,27 @@ class ACLManager(object):
 
     @staticmethod
     def authenticate_with_token(token):
+        """
+        verification results are cached for ACL_TOKEN_VERIFY_TTL seconds, keyed by the token hash
+        """
+        key = "ACL::TokenVerify::{0}".format(hashlib.sha256(token.encode("utf-8")).hexdigest())
+        result = cache.get(key)
+        if result is not None:
+            return result
+
         url = "{0}/acl/auth_with_token".format(current_app.config.get('ACL_URI'))
         try:
-            return requests.post(url, json={"token": token},
-                                 headers={'App-Access-Token': AccessTokenCache.get()}).json()
-        except:
+            result = HttpClient.post(url, json={"token": token},
+                                     headers={'App-Access-Token': AccessTokenCache.get()}).json()
+        except Exception as e:
+            current_app.logger.error("authenticate with token error, {0}".format(str(e)))
             return {}
 
+        if isinstance(result, dict) and 'authenticated' in result:
+            cache.set(key, result, timeout=current_app.config.get("ACL_TOKEN_VERIFY_TTL", 60))
+
+        return result
+
 
 def validate_permission(resources, resource_type, perm, app=None):
     if not resources:
@@ -247,26 +263,89 @@ def has_perm(resources, resource_type, perm, app=None):
     return decorator_has_perm
 
 
-def is_app_admin(app=None):
-    app = app or 'cmdb'
+def session_acl_from_user_info(user_info, avatar=None):
+    return dict(uid=user_info.get("uid"),
+                avatar=avatar,
+                userId=user_info.get("uid"),
+                userName=user_info.get("username"),
+                nickName=user_info.get("nickname"),
+                parentRoles=user_info.get("parents"),
+                childRoles=user_info.get("children"),
+                roleName=user_info.get("role"))
+
+
+class AuthContext(object):
+    """
+    authorization state of the current request, kept on flask.g
+    """
+
+    def __init__(self):
+        self.results = dict()
+        self.session_acl = None
+        self.app_admin = dict()
+
+    @classmethod
+    def get(cls):
+        ctx = getattr(g, "acl_auth_context", None)
+        if ctx is None:
+            ctx = g.acl_auth_context = cls()
+
+        return ctx
+
+    @classmethod
+    def reset_identity(cls):
+        ctx = cls.get()
+        ctx.session_acl = None
+        ctx.app_admin = dict()
+
+
+def get_session_acl():
+    """
+    session["acl"], completed on first access when reset_session deferred it, memoised for the request
+    """
+    ctx = AuthContext.get()
+    if ctx.session_acl is not None:
+        return ctx.session_acl
+
+    acl = session.get("acl") or {}
+    if acl.get("lazy"):
+        user_info = ACLManager.get_user_info(acl["lazy"])
+        acl = session_acl_from_user_info(user_info, acl["avatar"] if "avatar" in acl else user_info.get("avatar"))
+        session["acl"] = acl
+        session["uid"] = user_info.get("uuid")
+
+    ctx.session_acl = acl
+
+    return acl
+
+
+def get_parent_roles():
+    return get_session_acl().get("parentRoles") or []
+
+
+def _is_app_admin(app):
     app = AppCache.get(app)
     if app is None:
         return False
 
-    app_id = app.id
-    if 'acl_admin' in session.get("acl", {}).get("parentRoles", []):
+    parent_roles = set(get_parent_roles())
+    if 'acl_admin' in parent_roles:
         return True
 
-    for role_name in session.get("acl", {}).get("parentRoles", []):
-        role = RoleCache.get_by_name(app_id, role_name)
-        if role and role.is_app_admin:
-            return True
+    return bool(parent_roles & AppAdminRoleCache.get(app.id))
 
-    return False
+
+def is_app_admin(app=None):
+    app = app or 'cmdb'
+    ctx = AuthContext.get()
+    if app not in ctx.app_admin:
+        ctx.app_admin[app] = _is_app_admin(app)
+
+    return ctx.app_admin[app]
 
 
 def is_admin():
-    if 'acl_admin' in session.get("acl", {}).get("parentRoles", []):
+    if 'acl_admin' in get_parent_roles():
         return True
 
     return False
@@ -319,7 +398,7 @@ def role_required(role_name, app=None):
                 if getattr(current_user, 'username', None) == "worker":
                     return func(*args, **kwargs)
 
-                if role_name not in session.get("acl", {}).get("parentRoles", []) and not is_app_admin(app):
+                if role_name not in get_parent_roles() and not is_app_admin(app):
                     return abort(403, ErrFormat.role_required.format(role_name))
             return func(*args, **kwargs)
 
@@ -11,6 +11,8 @@ from api.extensions import db
 from api.lib.perm.acl.audit import AuditCRUD
 from api.lib.perm.acl.audit import AuditOperateType
 from api.lib.perm.acl.audit import AuditScope
+from api.lib.perm.acl.cache import AppAccessTokenCache
+from api.lib.perm.acl.cache import AppCache
 from api.lib.perm.acl.resp_format import ErrFormat
 from api.models.acl import App
 
@@ -55,7 +57,9 @@ class AppCRUD(object):
         existed = App.get_by_id(_id) or abort(404, ErrFormat.app_not_found.format("id={}".format(_id)))
 
         origin = existed.to_dict()
+        AppCache.clean(existed)
         existed = existed.update(**kwargs)
+        AppAccessTokenCache.clean()
 
         AuditCRUD.add_resource_log(existed.id, AuditOperateType.update,
                                    AuditScope.app, existed.id, origin, existed.to_dict(), {})
@@ -69,6 +73,9 @@ class AppCRUD(object):
 
         app.soft_delete()
 
+        AppCache.clean(app)
+        AppAccessTokenCache.clean()
+
         AuditCRUD.add_resource_log(app.id, AuditOperateType.delete,
                                    AuditScope.app, app.id, origin, {}, {})
 
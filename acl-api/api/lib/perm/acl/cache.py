@@ -1,55 +1,350 @@
 # -*- coding:utf-8 -*-
 
 
+import hashlib
+import json
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
 import msgpack
+from flask import current_app
+from redis.exceptions import WatchError
 
 from api.extensions import cache
+from api.extensions import db
+from api.extensions import rd
+from api.lib.db_session import use_master
 from api.lib.decorator import flush_db
 from api.lib.utils import Lock
 from api.models.acl import App
 from api.models.acl import Permission
 from api.models.acl import Resource
 from api.models.acl import ResourceGroup
+from api.models.acl import ResourceGroupItems
 from api.models.acl import Role
 from api.models.acl import User
 
 
+def _first(values):
+    return next((i for i in values if i), None)
+
+
+def _get_by_id_or(model, key, condition):
+    """
+    look up by primary key first, by the other condition only when that misses
+    condition must compare str(key), an int bound against a string column defeats its index on MySQL
+    """
+    obj = str(key).isdigit() and model.get_by_id(key)
+    if obj:
+        return obj
+
+    return model.get_by(only_query=True).filter(condition).first()
+
+
+class CacheRecord(object):
+    """
+    read-only copy of a model row, stored in redis as a msgpack dict
+    bump VERSION whenever the stored fields change so that old entries are ignored after a deploy
+    """
+    VERSION = "v1"
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getattr__(self, item):
+        if item.startswith('__') or item == '_data':
+            raise AttributeError(item)
+        try:
+            return self._data[item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def __getstate__(self):
+        return self._data
+
+    def __setstate__(self, state):
+        self._data = state
+
+    def __repr__(self):
+        return "<CacheRecord {0}>".format(self._data.get('id'))
+
+    def to_dict(self):
+        res = dict()
+        for k, v in self._data.items():
+            if k in {'password', '_password', 'secret', '_secret'}:
+                continue
+
+            res[k[1:] if k.startswith('_') else k] = v
+
+        return res
+
+    @classmethod
+    def versioned(cls, prefix):
+        return "{0}::{1}".format(cls.VERSION, prefix)
+
+    @staticmethod
+    def dumps(obj):
+        data = dict()
+        for k, is_temporal in obj.get_column_meta()[1]:
+            v = getattr(obj, k)
+            data[k] = str(v) if is_temporal and v is not None else v
+
+        return msgpack.dumps(data)
+
+    @classmethod
+    def loads(cls, value):
+        return cls(msgpack.loads(value, raw=False)) if value is not None else None
+
+    @classmethod
+    def from_model(cls, obj):
+        return cls.loads(cls.dumps(obj)) if obj is not None else None
+
+
+class LocalCache(object):
+    """
+    optional per-worker LRU/TTL tier in front of redis, configured by ACL_LOCAL_CACHE
+    entries are stamped with the generation of their namespace, which clean() bumps in redis
+    """
+    PREFIX_VERSION = "LocalCache::version::{0}"
+
+    _data = OrderedDict()
+    _versions = dict()
+    _lock = threading.RLock()
+    _stats = dict(hits=0, misses=0)
+
+    @staticmethod
+    def _config():
+        return current_app.config.get("ACL_LOCAL_CACHE") or {}
+
+    @classmethod
+    def enabled(cls):
+        return bool(cls._config().get("enabled"))
+
+    @classmethod
+    def _version(cls, namespace):
+        now = time.time()
+        with cls._lock:
+            checked = cls._versions.get(namespace)
+        version, checked_at = checked or (None, 0)
+        if now - checked_at >= cls._config().get("version_check_interval", 1):
+            version = cache.get(cls.PREFIX_VERSION.format(namespace)) or 0
+            with cls._lock:
+                # a bump() meanwhile replaced the entry, the version read above may predate it
+                if cls._versions.get(namespace) is checked:
+                    cls._versions[namespace] = (version, now)
+
+        return version
+
+    @classmethod
+    def get(cls, namespace, key):
+        if not cls.enabled():
+            return
+
+        version = cls._version(namespace)
+        with cls._lock:
+            item = cls._data.get((namespace, key))
+            if item is not None and item[1] == version and item[2] > time.time():
+                cls._data.move_to_end((namespace, key))
+                cls._stats['hits'] += 1
+
+                return pickle.loads(item[0])
+
+            cls._data.pop((namespace, key), None)
+            cls._stats['misses'] += 1
+
+    @classmethod
+    def set(cls, namespace, key, value):
+        if not cls.enabled() or value is None:
+            return
+
+        config = cls._config()
+        version = cls._version(namespace)
+        with cls._lock:
+            cls._data[(namespace, key)] = (pickle.dumps(value), version, time.time() + config.get("ttl", 60))
+            cls._data.move_to_end((namespace, key))
+            while len(cls._data) > config.get("maxsize", 10000):
+                cls._data.popitem(last=False)
+
+    @classmethod
+    def bump(cls, namespace):
+        if not cls.enabled():
+            return
+
+        if not cache.inc(cls.PREFIX_VERSION.format(namespace)):
+            cache.set(cls.PREFIX_VERSION.format(namespace), 1, timeout=0)
+        with cls._lock:
+            cls._versions[namespace] = (None, 0)
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return dict(size=len(cls._data), **cls._stats)
+
+
+class ETagCache(object):
+    """
+    builds ETags from version stamps, salted with an epoch that is regenerated whenever redis loses it
+    so that counters restarting from zero never reproduce an old ETag
+    """
+    KEY_EPOCH = "ETag::epoch"
+
+    @classmethod
+    def make(cls, *parts):
+        epoch = cache.get(cls.KEY_EPOCH)
+        if epoch is None:
+            cache.add(cls.KEY_EPOCH, uuid.uuid4().hex, timeout=0)
+            epoch = cache.get(cls.KEY_EPOCH)
+
+        return hashlib.md5("::".join(str(i) for i in (epoch,) + parts).encode("utf-8")).hexdigest()
+
+
 class AppAccessTokenCache(object):
+    """
+    App-Access-Token -> app id, keyed by the token hash and expiring together with the token
+    app updates and deletions bump the generation, which drops every entry at once
+    """
     PREFIX = "AppAccessTokenCache::token::{}"
+    KEY_VERSION = "AppAccessTokenCache::version"
+
+    @staticmethod
+    def _hash(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
 
     @classmethod
     def get_app_id(cls, token):
-        app_id = cache.get(cls.PREFIX.format(token))
-        return app_id
+        version, value = cache.get_many(cls.KEY_VERSION, cls.PREFIX.format(cls._hash(token)))
+        if value is not None and value[1] == (version or 0):
+            return value[0]
+
+    @classmethod
+    def set(cls, token, app, exp):
+        """
+        :param exp: the exp claim of the token
+        """
+        timeout = int(exp - time.time())
+        if timeout > 0:
+            cache.set(cls.PREFIX.format(cls._hash(token)), (app.id, cache.get(cls.KEY_VERSION) or 0), timeout=timeout)
+
+    @classmethod
+    def clean(cls):
+        if not cache.inc(cls.KEY_VERSION):
+            cache.set(cls.KEY_VERSION, 1, timeout=0)
+
+
+class CredentialCache(object):
+    """
+    _key of a user or a role -> ("user", uid) or ("role", rid)
+    """
+    PREFIX_KEY = "Credential::key::{0}"
+
+    @classmethod
+    @use_master
+    def get(cls, key):
+        principal = cache.get(cls.PREFIX_KEY.format(key))
+        if principal is None:
+            user = User.get_by(key=key, first=True, to_dict=False)
+            role = user is None and Role.get_by(key=key, first=True, to_dict=False)
+            principal = ("user", user.uid) if user is not None else (role and ("role", role.id))
+            principal and cache.set(cls.PREFIX_KEY.format(key), principal, timeout=0)
+
+        return principal or None
+
+    @classmethod
+    def set(cls, key, principal_type, _id):
+        cache.set(cls.PREFIX_KEY.format(key), (principal_type, _id), timeout=0)
+
+    @classmethod
+    def clean(cls, key):
+        key and cache.delete(cls.PREFIX_KEY.format(key))
+
+
+class AuthIdentityCache(object):
+    """
+    resolved identity of _key/_secret and JWT callers, expires after ACL_AUTH_IDENTITY_TTL seconds
+    role relation changes bump the generation, which drops every entry at once
+    """
+    PREFIX_KEY = "AuthIdentity::key::{0}"
+    PREFIX_SUB = "AuthIdentity::sub::{0}"
+    KEY_VERSION = "AuthIdentity::version"
 
     @classmethod
-    def set(cls, token, app, timeout=7200):
-        cache.set(token, cls.PREFIX.format(app.app_id), timeout=timeout)
+    def _get_or_load(cls, name, load):
+        version, identity = cache.get_many(cls.KEY_VERSION, name)
+        version = version or 0
+        if identity is not None and identity.get('version') == version:
+            return identity
+
+        identity = load()
+        if identity is not None:
+            identity['version'] = version
+            cache.set(name, identity, timeout=current_app.config.get("ACL_AUTH_IDENTITY_TTL", 300))
+
+        return identity
+
+    @classmethod
+    def get_by_key(cls, key, load):
+        """
+        :param load: called on a miss, returns {username, role, secret} or None
+        """
+        return cls._get_or_load(cls.PREFIX_KEY.format(key), load)
+
+    @classmethod
+    def get_by_sub(cls, sub, load):
+        return cls._get_or_load(cls.PREFIX_SUB.format(sub), load)
+
+    @classmethod
+    def clean(cls, key=None, sub=None):
+        key and cache.delete(cls.PREFIX_KEY.format(key))
+        sub and cache.delete(cls.PREFIX_SUB.format(sub))
+
+    @classmethod
+    def bump(cls):
+        if not cache.inc(cls.KEY_VERSION):
+            cache.set(cls.KEY_VERSION, 1, timeout=0)
+
+    @classmethod
+    def get_version(cls):
+        return cache.get(cls.KEY_VERSION) or 0
 
 
 class AppCache(object):
-    PREFIX_ID = "App::id::{0}"
-    PREFIX_NAME = "App::name::{0}"
+    PREFIX_ID = CacheRecord.versioned("App::id::{0}")
+    PREFIX_NAME = CacheRecord.versioned("App::name::{0}")
 
     @classmethod
+    @use_master
     def get(cls, key):
-        app = cache.get(cls.PREFIX_ID.format(key)) or cache.get(cls.PREFIX_NAME.format(key))
+        app = LocalCache.get("App", key)
+        if app is not None:
+            return app
+
+        app = CacheRecord.loads(_first(cache.get_many(cls.PREFIX_ID.format(key), cls.PREFIX_NAME.format(key))))
         if app is None:
-            app = App.get_by_id(key) or App.get_by(name=key, to_dict=False, first=True)
+            app = _get_by_id_or(App, key, App.name == str(key))
+            app = app and cls.set(app)
         if app is not None:
-            cls.set(app)
+            LocalCache.set("App", key, app)
 
         return app
 
     @classmethod
     def set(cls, app):
-        cache.set(cls.PREFIX_ID.format(app.id), app)
-        cache.set(cls.PREFIX_NAME.format(app.name), app)
+        value = CacheRecord.dumps(app)
+        cache.set_many({cls.PREFIX_ID.format(app.id): value,
+                        cls.PREFIX_NAME.format(app.name): value})
+
+        return CacheRecord.loads(value)
 
     @classmethod
     def clean(cls, app):
         cache.delete(cls.PREFIX_ID.format(app.id))
         cache.delete(cls.PREFIX_NAME.format(app.name))
+        LocalCache.bump("App")
 
 
 class UserCache(object):
@@ -57,30 +352,55 @@ class UserCache(object):
     PREFIX_NAME = "User::username::{0}"
     PREFIX_NICK = "User::nickname::{0}"
     PREFIX_WXID = "User::wxid::{0}"
+    PREFIX_VERSION = "User::version::{0}"
 
     @classmethod
+    @use_master
     def get(cls, key):
-        user = (cache.get(cls.PREFIX_ID.format(key)) or
-                cache.get(cls.PREFIX_NAME.format(key)) or
-                cache.get(cls.PREFIX_NICK.format(key)) or
-                cache.get(cls.PREFIX_WXID.format(key)))
+        user = LocalCache.get("User", key)
+        if user is not None:
+            return user
+
+        user = _first(cache.get_many(cls.PREFIX_ID.format(key),
+                                     cls.PREFIX_NAME.format(key),
+                                     cls.PREFIX_NICK.format(key),
+                                     cls.PREFIX_WXID.format(key)))
         if not user:
-            user = (User.query.get(key) or
-                    User.query.get_by_username(key) or
-                    User.query.get_by_nickname(key) or
-                    User.query.get_by_wxid(key))
+            user = User.query.get_by_key(key)
+            if user:
+                cls.set(user)
         if user:
-            cls.set(user)
+            LocalCache.set("User", key, user)
 
         return user
 
+    @classmethod
+    @use_master
+    def get_many(cls, uids):
+        """
+        :return: {uid: user or None}
+        """
+        uids = list(set(uids))
+        if not uids:
+            return dict()
+
+        uid2user = dict(zip(uids, cache.get_many(*[cls.PREFIX_ID.format(uid) for uid in uids])))
+        missing = [uid for uid, user in uid2user.items() if not user]
+        if missing:
+            for user in User.query.filter(User.uid.in_(missing)):
+                uid2user[user.uid] = user
+                cls.set(user)
+
+        return uid2user
+
     @classmethod
     def set(cls, user):
-        cache.set(cls.PREFIX_ID.format(user.uid), user)
-        cache.set(cls.PREFIX_NAME.format(user.username), user)
-        cache.set(cls.PREFIX_NICK.format(user.nickname), user)
+        mapping = {cls.PREFIX_ID.format(user.uid): user,
+                   cls.PREFIX_NAME.format(user.username): user,
+                   cls.PREFIX_NICK.format(user.nickname): user}
         if user.wx_id:
-            cache.set(cls.PREFIX_WXID.format(user.wx_id), user)
+            mapping[cls.PREFIX_WXID.format(user.wx_id)] = user
+        cache.set_many(mapping)
 
     @classmethod
     def clean(cls, user):
@@ -89,42 +409,116 @@ class UserCache(object):
         cache.delete(cls.PREFIX_NICK.format(user.nickname))
         if user.wx_id:
             cache.delete(cls.PREFIX_WXID.format(user.wx_id))
+        LocalCache.bump("User")
+        if not cache.inc(cls.PREFIX_VERSION.format(user.username)):
+            cache.set(cls.PREFIX_VERSION.format(user.username), 1, timeout=0)
+
+    @classmethod
+    def get_version(cls, username):
+        return cache.get(cls.PREFIX_VERSION.format(username)) or 0
 
 
 class RoleCache(object):
-    PREFIX_ID = "Role::id::{0}"
-    PREFIX_NAME = "Role::app_id::{0}::name::{1}"
+    PREFIX_ID = CacheRecord.versioned("Role::id::{0}")
+    PREFIX_NAME = CacheRecord.versioned("Role::app_id::{0}::name::{1}")
 
     @classmethod
+    @use_master
     def get_by_name(cls, app_id, name):
-        role = cache.get(cls.PREFIX_NAME.format(app_id, name))
+        role = LocalCache.get("Role", cls.PREFIX_NAME.format(app_id, name))
+        if role is not None:
+            return role
+
+        role = CacheRecord.loads(cache.get(cls.PREFIX_NAME.format(app_id, name)))
         if role is None:
             role = Role.get_by(app_id=app_id, name=name, first=True, to_dict=False)
             if role is None and app_id is None:  # try global role
                 role = Role.get_by(name=name, first=True, to_dict=False)
 
             if role is not None:
-                cache.set(cls.PREFIX_NAME.format(app_id, name), role)
+                value = CacheRecord.dumps(role)
+                cache.set(cls.PREFIX_NAME.format(app_id, name), value)
+                role = CacheRecord.loads(value)
+        LocalCache.set("Role", cls.PREFIX_NAME.format(app_id, name), role)
 
         return role
 
     @classmethod
+    @use_master
     def get(cls, rid):
-        role = cache.get(cls.PREFIX_ID.format(rid))
+        role = LocalCache.get("Role", cls.PREFIX_ID.format(rid))
+        if role is not None:
+            return role
+
+        role = CacheRecord.loads(cache.get(cls.PREFIX_ID.format(rid)))
         if role is None:
             role = Role.get_by_id(rid)
             if role is not None:
-                cache.set(cls.PREFIX_ID.format(rid), role)
+                value = CacheRecord.dumps(role)
+                cache.set(cls.PREFIX_ID.format(rid), value)
+                role = CacheRecord.loads(value)
+        LocalCache.set("Role", cls.PREFIX_ID.format(rid), role)
 
         return role
 
+    @classmethod
+    @use_master
+    def get_many(cls, rids):
+        """
+        :return: {rid: role or None}
+        """
+        rids = list(set(rids))
+        if not rids:
+            return dict()
+
+        values = cache.get_many(*[cls.PREFIX_ID.format(rid) for rid in rids])
+        rid2role = {rid: CacheRecord.loads(value) for rid, value in zip(rids, values)}
+        missing = [rid for rid, role in rid2role.items() if role is None]
+        if missing:
+            mapping = dict()
+            for role in Role.get_by(__func_in___key_id=missing, to_dict=False):
+                mapping[cls.PREFIX_ID.format(role.id)] = CacheRecord.dumps(role)
+                rid2role[role.id] = CacheRecord.loads(mapping[cls.PREFIX_ID.format(role.id)])
+            mapping and cache.set_many(mapping)
+
+        return rid2role
+
     @classmethod
     def clean(cls, rid):
         cache.delete(cls.PREFIX_ID.format(rid))
+        LocalCache.bump("Role")
 
     @classmethod
     def clean_by_name(cls, app_id, name):
         cache.delete(cls.PREFIX_NAME.format(app_id, name))
+        LocalCache.bump("Role")
+
+
+class AppAdminRoleCache(object):
+    """
+    names of the roles with is_app_admin set, per app
+    """
+    PREFIX_KEY = "AppAdminRoles::AppId::{0}"
+
+    @classmethod
+    @use_master
+    def get(cls, app_id):
+        names = LocalCache.get("AppAdminRoles", app_id)
+        if names is not None:
+            return names
+
+        names = cache.get(cls.PREFIX_KEY.format(app_id))
+        if names is None:
+            names = set(i.name for i in Role.get_by(app_id=app_id, is_app_admin=True, to_dict=False))
+            cache.set(cls.PREFIX_KEY.format(app_id), names, timeout=0)
+        LocalCache.set("AppAdminRoles", app_id, names)
+
+        return names
+
+    @classmethod
+    def clean(cls, *app_ids):
+        cache.delete_many(*[cls.PREFIX_KEY.format(app_id) for app_id in app_ids])
+        LocalCache.bump("AppAdminRoles")
 
 
 class HasResourceRoleCache(object):
@@ -154,8 +548,12 @@ class RoleRelationCache(object):
     PREFIX_CHILDREN = "RoleRelationChildren::id::{0}::AppId::{1}"
     PREFIX_RESOURCES = "RoleRelationResources::id::{0}::AppId::{1}"
     PREFIX_RESOURCES2 = "RoleRelationResources2::id::{0}::AppId::{1}"
+    PREFIX_ANCESTORS = "RoleRelationAncestors::id::{0}::AppId::{1}"
+    PREFIX_DESCENDANTS = "RoleRelationDescendants::id::{0}::AppId::{1}"
+    PREFIX_VERSION = "RoleRelationVersion::id::{0}::AppId::{1}"
 
     @classmethod
+    @use_master
     def get_parent_ids(cls, rid, app_id):
         parent_ids = cache.get(cls.PREFIX_PARENT.format(rid, app_id))
         if not parent_ids:
@@ -166,6 +564,7 @@ class RoleRelationCache(object):
         return parent_ids
 
     @classmethod
+    @use_master
     def get_child_ids(cls, rid, app_id):
         child_ids = cache.get(cls.PREFIX_CHILDREN.format(rid, app_id))
         if not child_ids:
@@ -176,6 +575,75 @@ class RoleRelationCache(object):
         return child_ids
 
     @classmethod
+    @use_master
+    def _walk(cls, rid, app_id, get_ids):
+        result = {int(rid)}
+        todo = [int(rid)]
+        while todo:
+            for _id in get_ids(todo.pop(), app_id):
+                if int(_id) not in result:
+                    result.add(int(_id))
+                    todo.append(int(_id))
+
+        return result
+
+    @classmethod
+    def get_ancestor_ids(cls, rid, app_id):
+        """
+        transitive closure of the parents, including rid itself
+        """
+        ancestor_ids = cache.get(cls.PREFIX_ANCESTORS.format(rid, app_id))
+        if not ancestor_ids:
+            ancestor_ids = cls._walk(rid, app_id, cls.get_parent_ids)
+            cache.set(cls.PREFIX_ANCESTORS.format(rid, app_id), ancestor_ids, timeout=0)
+
+        return set(ancestor_ids)
+
+    @classmethod
+    def get_descendant_ids(cls, rid, app_id):
+        """
+        transitive closure of the children, including rid itself
+        """
+        descendant_ids = cache.get(cls.PREFIX_DESCENDANTS.format(rid, app_id))
+        if not descendant_ids:
+            descendant_ids = cls._walk(rid, app_id, cls.get_child_ids)
+            cache.set(cls.PREFIX_DESCENDANTS.format(rid, app_id), descendant_ids, timeout=0)
+
+        return set(descendant_ids)
+
+    @classmethod
+    def add_closure(cls, parent_id, child_id, app_id):
+        """
+        merge the new edge parent_id -> child_id into the closure index
+        the closures are read under the lock, a concurrent add could otherwise merge into what it has not seen
+        """
+        with Lock('RoleRelationClosure'):
+            ancestor_ids = cls.get_ancestor_ids(parent_id, app_id)
+            descendant_ids = cls.get_descendant_ids(child_id, app_id)
+
+            for _id in descendant_ids:
+                cache.set(cls.PREFIX_ANCESTORS.format(_id, app_id),
+                          cls.get_ancestor_ids(_id, app_id) | ancestor_ids, timeout=0)
+            for _id in ancestor_ids:
+                cache.set(cls.PREFIX_DESCENDANTS.format(_id, app_id),
+                          cls.get_descendant_ids(_id, app_id) | descendant_ids, timeout=0)
+
+        RoleEffectivePermCache.clean(descendant_ids, app_id)
+
+    @classmethod
+    def clean_closure(cls, ancestor_ids, descendant_ids, app_id):
+        """
+        a removed edge may still be reachable through another path, so the affected
+        entries are dropped and recomputed on the next read
+        """
+        with Lock('RoleRelationClosure'):
+            cache.delete_many(*[cls.PREFIX_ANCESTORS.format(_id, app_id) for _id in descendant_ids])
+            cache.delete_many(*[cls.PREFIX_DESCENDANTS.format(_id, app_id) for _id in ancestor_ids])
+
+        RoleEffectivePermCache.clean(descendant_ids, app_id)
+
+    @classmethod
+    @use_master
     def get_resources(cls, rid, app_id):
         """
         :param rid: 
@@ -192,6 +660,7 @@ class RoleRelationCache(object):
         return resources or {}
 
     @classmethod
+    @use_master
     def get_resources2(cls, rid, app_id):
         r_g = cache.get(cls.PREFIX_RESOURCES2.format(rid, app_id))
         if not r_g:
@@ -220,25 +689,136 @@ class RoleRelationCache(object):
 
         return msgpack.loads(r_g, raw=False)
 
+    @classmethod
+    @use_master
+    def get_resources2_many(cls, rids, app_id):
+        """
+        :return: {rid: {resources: {resource_id: resource}, groups: {group_id: group}}}
+        """
+        rids = list(set(rids))
+        if not rids:
+            return dict()
+
+        values = cache.get_many(*[cls.PREFIX_RESOURCES2.format(rid, app_id) for rid in rids])
+        result = dict()
+        for rid, value in zip(rids, values):
+            result[rid] = msgpack.loads(value, raw=False) if value else cls.get_resources2(rid, app_id)
+
+        return result
+
     @classmethod
     @flush_db
+    @use_master
     def rebuild(cls, rid, app_id):
-        cls.clean(rid, app_id)
+        # a delta applied between our read and write would be overwritten, so hold it off and reject it after
+        with cls._lock(rid, app_id):
+            cls.clean(rid, app_id)
 
-        cls.get_parent_ids(rid, app_id)
-        cls.get_child_ids(rid, app_id)
-        resources = cls.get_resources(rid, app_id)
-        if resources.get('id2perms') or resources.get('group2perms'):
-            HasResourceRoleCache.add(rid, app_id)
-        else:
-            HasResourceRoleCache.remove(rid, app_id)
-        cls.get_resources2(rid, app_id)
+            cls.get_parent_ids(rid, app_id)
+            cls.get_child_ids(rid, app_id)
+            resources = cls.get_resources(rid, app_id)
+            if resources.get('id2perms') or resources.get('group2perms'):
+                HasResourceRoleCache.add(rid, app_id)
+            else:
+                HasResourceRoleCache.remove(rid, app_id)
+            cls.get_resources2(rid, app_id)
+
+            cls._bump_version(rid, app_id)
+
+        RoleEffectivePermCache.clean(cls.get_descendant_ids(rid, app_id), app_id)
+        RoleEffectivePermCache.build(rid, app_id)
 
     @classmethod
     @flush_db
+    @use_master
     def rebuild2(cls, rid, app_id):
-        cache.delete(cls.PREFIX_RESOURCES2.format(rid, app_id))
-        cls.get_resources2(rid, app_id)
+        with cls._lock(rid, app_id):
+            cache.delete(cls.PREFIX_RESOURCES2.format(rid, app_id))
+            cls.get_resources2(rid, app_id)
+
+            cls._bump_version(rid, app_id)
+
+        RoleEffectivePermCache.notify(cls.get_descendant_ids(rid, app_id), app_id)
+
+    @staticmethod
+    def _lock(rid, app_id):
+        """
+        serialises the writers of the resources of a role: rebuild, rebuild2 and apply_delta
+        """
+        return Lock("RoleRelationCache::{0}::{1}".format(rid, app_id))
+
+    @classmethod
+    def get_version(cls, rid, app_id):
+        return cache.get(cls.PREFIX_VERSION.format(rid, app_id)) or 0
+
+    @classmethod
+    def _bump_version(cls, rid, app_id):
+        if not cache.inc(cls.PREFIX_VERSION.format(rid, app_id)):
+            cache.set(cls.PREFIX_VERSION.format(rid, app_id), 1, timeout=0)
+
+    @staticmethod
+    def _apply_perms(perms, changed, grant):
+        return list(set(perms) | set(changed)) if grant else [i for i in perms if i not in changed]
+
+    @classmethod
+    @use_master
+    def apply_delta(cls, rid, app_id, version, changes, grant=True):
+        """
+        patch the cached resources of a role in place
+        :param version: get_version() when the change was published
+        :param changes: [(resource_id, group_id, [perm, ]), ]
+        :param grant: grant or revoke
+        :return: False if the cache has moved on since version, the caller should rebuild
+        """
+        with cls._lock(rid, app_id):
+            if cls.get_version(rid, app_id) != version:
+                return False
+
+            resources = cache.get(cls.PREFIX_RESOURCES.format(rid, app_id))
+            if resources:
+                for resource_id, group_id, perms in changes:
+                    key, _id = ('id2perms', int(resource_id)) if resource_id else ('group2perms', int(group_id))
+                    resources[key][_id] = cls._apply_perms(resources[key].get(_id, []), perms, grant)
+                    resources[key][_id] or resources[key].pop(_id)
+
+                if resources['id2perms'] or resources['group2perms']:
+                    cache.set(cls.PREFIX_RESOURCES.format(rid, app_id), resources, timeout=0)
+                else:
+                    cache.delete(cls.PREFIX_RESOURCES.format(rid, app_id))
+            else:
+                resources = cls.get_resources(rid, app_id)
+
+            if resources.get('id2perms') or resources.get('group2perms'):
+                HasResourceRoleCache.add(rid, app_id)
+            else:
+                HasResourceRoleCache.remove(rid, app_id)
+
+            r_g = cache.get(cls.PREFIX_RESOURCES2.format(rid, app_id))
+            if r_g:
+                r_g = msgpack.loads(r_g, raw=False)
+                for resource_id, group_id, perms in changes:
+                    if resource_id:
+                        key, _id, obj_cache = 'resources', int(resource_id), ResourceCache
+                    else:
+                        key, _id, obj_cache = 'groups', int(group_id), ResourceGroupCache
+
+                    if _id not in r_g[key]:
+                        obj = grant and obj_cache.get(_id)
+                        if not obj:
+                            continue
+                        r_g[key][_id] = obj.to_dict()
+                        r_g[key][_id]['permissions'] = []
+
+                    r_g[key][_id]['permissions'] = cls._apply_perms(r_g[key][_id]['permissions'], perms, grant)
+                    r_g[key][_id]['permissions'] or r_g[key].pop(_id)
+
+                cache.set(cls.PREFIX_RESOURCES2.format(rid, app_id), msgpack.dumps(r_g), timeout=0)
+
+            cls._bump_version(rid, app_id)
+
+        RoleEffectivePermCache.clean(cls.get_descendant_ids(rid, app_id), app_id)
+
+        return True
 
     @classmethod
     def clean(cls, rid, app_id):
@@ -246,47 +826,344 @@ class RoleRelationCache(object):
         cache.delete(cls.PREFIX_CHILDREN.format(rid, app_id))
         cache.delete(cls.PREFIX_RESOURCES.format(rid, app_id))
         cache.delete(cls.PREFIX_RESOURCES2.format(rid, app_id))
+        cache.delete(cls.PREFIX_ANCESTORS.format(rid, app_id))
+        cache.delete(cls.PREFIX_DESCENDANTS.format(rid, app_id))
+
+
+class RoleRebuildQueue(object):
+    """
+    dirty (rid, app_id) pairs waiting for role_rebuild, drained in batches by acl.role_rebuild_drain
+    """
+    KEY_DIRTY = "RoleRebuildQueue::dirty"
+    KEY_SCHEDULED = "RoleRebuildQueue::scheduled"
+    KEY_STATS = "RoleRebuildQueue::stats"
+    KEY_FAILURES = "RoleRebuildQueue::failures"
+
+    @staticmethod
+    def _member(rid, app_id):
+        return "{0}::{1}".format(rid, app_id)
+
+    @classmethod
+    def add(cls, rids, app_id, countdown):
+        """
+        :return: True if no drain is scheduled yet and the caller should schedule one
+        """
+        pipe = rd.r.pipeline()
+        pipe.sadd(cls.KEY_DIRTY, *[cls._member(rid, app_id) for rid in rids])
+        pipe.hincrby(cls.KEY_STATS, "requested", len(rids))
+        pipe.set(cls.KEY_SCHEDULED, 1, nx=True, ex=int(countdown) + 60)
+
+        return bool(pipe.execute()[-1])
+
+    @classmethod
+    def retry(cls, items, countdown, max_failures):
+        """
+        put the items whose rebuild failed back, an item failing max_failures times in a row is dropped
+        :param items: [(rid, app_id), ]
+        :return: (True if the caller should schedule a drain, [dropped (rid, app_id), ])
+        """
+        members = [cls._member(rid, app_id) for rid, app_id in items]
+        pipe = rd.r.pipeline()
+        for member in members:
+            pipe.hincrby(cls.KEY_FAILURES, member, 1)
+        failures = pipe.execute()
+
+        retried = [m for m, n in zip(members, failures) if n < max_failures]
+        dropped = [(i, m) for i, m, n in zip(items, members, failures) if n >= max_failures]
+
+        pipe = rd.r.pipeline()
+        if dropped:
+            pipe.hdel(cls.KEY_FAILURES, *[m for _, m in dropped])
+            pipe.hincrby(cls.KEY_STATS, "dropped", len(dropped))
+        if retried:
+            pipe.sadd(cls.KEY_DIRTY, *retried)
+            pipe.set(cls.KEY_SCHEDULED, 1, nx=True, ex=int(countdown) + 60)
+        result = pipe.execute()
+
+        return bool(retried and result[-1]), [i for i, _ in dropped]
+
+    @classmethod
+    def unschedule(cls):
+        rd.r.delete(cls.KEY_SCHEDULED)
+
+    @classmethod
+    def pop(cls, count):
+        result = []
+        for i in rd.r.spop(cls.KEY_DIRTY, count) or []:
+            rid, app_id = i.decode().split("::")
+            result.append((int(rid), None if app_id == "None" else int(app_id)))
+
+        return result
+
+    @classmethod
+    def done(cls, items):
+        """
+        :param items: [(rid, app_id), ] rebuilt successfully, their failure count starts over
+        """
+        if not items:
+            return
+
+        pipe = rd.r.pipeline()
+        pipe.hincrby(cls.KEY_STATS, "rebuilt", len(items))
+        pipe.hdel(cls.KEY_FAILURES, *[cls._member(rid, app_id) for rid, app_id in items])
+        pipe.execute()
+
+    @classmethod
+    def stats(cls):
+        stats = rd.r.hgetall(cls.KEY_STATS) or {}
+        requested = int(stats.get(b"requested") or 0)
+        rebuilt = int(stats.get(b"rebuilt") or 0)
+
+        return dict(requested=requested,
+                    rebuilt=rebuilt,
+                    dropped=int(stats.get(b"dropped") or 0),
+                    pending=rd.r.scard(cls.KEY_DIRTY),
+                    coalescing_ratio=round(1 - float(rebuilt) / requested, 4) if requested else 0)
+
+
+class RoleEffectivePermCache(object):
+    """
+    compiled permissions of a role, inherited and group grants included
+    redis hash: {resource_id: permission bitmask, PERMS_FIELD: json list of permission names (bit order)}
+    clean() bumps the generation of the role, build() only stores a hash compiled within one generation
+    """
+    PREFIX_KEY = "RoleEffectivePerm::id::{0}::AppId::{1}"
+    PREFIX_GEN = "RoleEffectivePerm::gen::id::{0}::AppId::{1}"
+    PERMS_FIELD = "__perms__"
+    KEY_SEQ = "RoleEffectivePerm::seq"
+    PREFIX_CHANGES = "RoleEffectivePerm::changes::AppId::{0}"  # sorted set: rid -> seq of its last change
+    CHANNEL = "acl::perm_changes"
+
+    @classmethod
+    def _compile(cls, rid, app_id):
+        perms = []
+        id2mask = dict()
+        group2mask = dict()
+
+        def _mask(names):
+            mask = 0
+            for name in names:
+                if name not in perms:
+                    perms.append(name)
+                mask |= 1 << perms.index(name)
+
+            return mask
+
+        for parent_id in RoleRelationCache.get_ancestor_ids(rid, app_id):
+            res = RoleRelationCache.get_resources(parent_id, app_id)
+            for _id, names in (res.get('id2perms') or {}).items():
+                id2mask[_id] = id2mask.get(_id, 0) | _mask(names)
+            for _id, names in (res.get('group2perms') or {}).items():
+                group2mask[_id] = group2mask.get(_id, 0) | _mask(names)
+
+        if group2mask:
+            for group_id, resource_ids in ResourceGroupItemsCache.get_resource_ids_many(group2mask).items():
+                for _id in resource_ids:
+                    id2mask[_id] = id2mask.get(_id, 0) | group2mask[group_id]
+
+        return perms, id2mask
+
+    @classmethod
+    @use_master
+    def build(cls, rid, app_id):
+        gen_key = cls.PREFIX_GEN.format(rid, app_id)
+        try:
+            gen = rd.r.get(gen_key)
+        except Exception as e:
+            current_app.logger.error("get role effective permissions generation error, {0}".format(str(e)))
+            return cls._compile(rid, app_id)
+
+        perms, id2mask = cls._compile(rid, app_id)
+
+        mapping = {str(_id): mask for _id, mask in id2mask.items()}
+        mapping[cls.PERMS_FIELD] = json.dumps(perms)
+        key = cls.PREFIX_KEY.format(rid, app_id)
+        try:
+            with rd.r.pipeline() as pipe:
+                pipe.watch(gen_key)
+                if pipe.get(gen_key) == gen:
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.hmset(key, mapping)
+                    pipe.execute()
+        except WatchError:  # cleaned while compiling, what was read may be stale
+            pass
+        except Exception as e:
+            current_app.logger.error("build role effective permissions error, {0}".format(str(e)))
+
+        return perms, id2mask
+
+    @classmethod
+    def get_all(cls, rid, app_id):
+        """
+        :return: (perms, {resource_id: bitmask})
+        """
+        try:
+            value = rd.r.hgetall(cls.PREFIX_KEY.format(rid, app_id)) or {}
+        except Exception as e:
+            current_app.logger.error("get role effective permissions error, {0}".format(str(e)))
+            value = {}
+
+        perms = value.pop(cls.PERMS_FIELD.encode(), None)
+        if perms is None:
+            return cls.build(rid, app_id)
+
+        return json.loads(perms), {int(k): int(v) for k, v in value.items()}
+
+    @classmethod
+    def has_permission(cls, rid, app_id, resource_id, perm):
+        value = rd.get([str(resource_id), cls.PERMS_FIELD], cls.PREFIX_KEY.format(rid, app_id))
+        if not value or value[1] is None:
+            perms, id2mask = cls.build(rid, app_id)
+            mask = id2mask.get(int(resource_id), 0)
+        else:
+            perms, mask = json.loads(value[1]), int(value[0] or 0)
+
+        return perm in perms and bool(mask & (1 << perms.index(perm)))
+
+    @classmethod
+    def has_permissions(cls, rid, app_id, resource_perms):
+        """
+        :param resource_perms: [(resource_id, perm), ]
+        :return: [bool, ]
+        """
+        fields = [str(resource_id) for resource_id, _ in resource_perms] + [cls.PERMS_FIELD]
+        value = rd.get(fields, cls.PREFIX_KEY.format(rid, app_id))
+        if not value or value[-1] is None:
+            perms, id2mask = cls.build(rid, app_id)
+            masks = [id2mask.get(int(resource_id), 0) for resource_id, _ in resource_perms]
+        else:
+            perms, masks = json.loads(value[-1]), [int(i or 0) for i in value[:-1]]
+
+        return [perm in perms and bool(mask & (1 << perms.index(perm)))
+                for (_, perm), mask in zip(resource_perms, masks)]
+
+    @classmethod
+    def clean(cls, rids, app_id):
+        try:
+            pipe = rd.r.pipeline()
+            for rid in rids:
+                pipe.incr(cls.PREFIX_GEN.format(rid, app_id))
+                pipe.delete(cls.PREFIX_KEY.format(rid, app_id))
+            pipe.execute()
+        except Exception as e:
+            current_app.logger.error("delete role effective permissions error, {0}".format(str(e)))
+
+        cls.notify(rids, app_id)
+
+    @classmethod
+    def notify(cls, rids, app_id):
+        """
+        record and publish a change of what the roles see, for snapshots and ETags
+        """
+        rids = [int(rid) for rid in rids]
+        if not rids:
+            return
+
+        try:
+            seq = rd.r.incr(cls.KEY_SEQ)
+            pipe = rd.r.pipeline()
+            pipe.zadd(cls.PREFIX_CHANGES.format(app_id), {rid: seq for rid in rids})
+            pipe.publish(cls.CHANNEL, json.dumps(dict(app_id=app_id, rids=rids, seq=seq)))
+            pipe.execute()
+        except Exception as e:
+            current_app.logger.error("notify role effective permissions change error, {0}".format(str(e)))
+
+    @classmethod
+    def get_seq(cls):
+        return int(rd.r.get(cls.KEY_SEQ) or 0)
+
+    @classmethod
+    def get_version(cls, rid, app_id):
+        """
+        seq of the last change of the effective permissions of the role, 0 if never changed
+        """
+        return int(rd.r.zscore(cls.PREFIX_CHANGES.format(app_id), rid) or 0)
+
+    @classmethod
+    def changes_since(cls, app_id, since):
+        """
+        :return: (current seq, [rid, ]) with the roles whose permissions changed after since
+        """
+        seq = cls.get_seq()
+        rids = rd.r.zrangebyscore(cls.PREFIX_CHANGES.format(app_id), "({0}".format(int(since)), "+inf")
+
+        return seq, [int(i) for i in rids]
 
 
 class PermissionCache(object):
-    PREFIX_ID = "Permission::id::{0}::ResourceTypeId::{1}"
-    PREFIX_NAME = "Permission::name::{0}::ResourceTypeId::{1}"
+    PREFIX_ID = CacheRecord.versioned("Permission::id::{0}::ResourceTypeId::{1}")
+    PREFIX_NAME = CacheRecord.versioned("Permission::name::{0}::ResourceTypeId::{1}")
 
     @classmethod
+    @use_master
     def get(cls, key, rt_id):
-        perm = cache.get(cls.PREFIX_ID.format(key, rt_id))
-        perm = perm or cache.get(cls.PREFIX_NAME.format(key, rt_id))
+        perm = LocalCache.get("Permission", (key, rt_id))
+        if perm is not None:
+            return perm
+
+        perm = CacheRecord.loads(_first(cache.get_many(cls.PREFIX_ID.format(key, rt_id),
+                                                       cls.PREFIX_NAME.format(key, rt_id))))
         if perm is None:
             perm = Permission.get_by_id(key)
             perm = perm or Permission.get_by(name=key, resource_type_id=rt_id, first=True, to_dict=False)
             if perm is not None:
-                cache.set(cls.PREFIX_ID.format(perm.id, rt_id), perm)
-                cache.set(cls.PREFIX_NAME.format(perm.name, rt_id), perm)
+                value = CacheRecord.dumps(perm)
+                cache.set_many({cls.PREFIX_ID.format(perm.id, rt_id): value,
+                                cls.PREFIX_NAME.format(perm.name, rt_id): value})
+                perm = CacheRecord.loads(value)
+        LocalCache.set("Permission", (key, rt_id), perm)
 
         return perm
 
 
 class ResourceCache(object):
-    PREFIX_ID = "Resource::id::{0}"
-    PREFIX_NAME = "Resource::type_id::{0}::name::{1}"
+    PREFIX_ID = CacheRecord.versioned("Resource::id::{0}")
+    PREFIX_NAME = CacheRecord.versioned("Resource::type_id::{0}::name::{1}")
 
     @classmethod
+    @use_master
     def get(cls, key, type_id=None):
-        resource = cache.get(cls.PREFIX_ID.format(key)) or cache.get(cls.PREFIX_NAME.format(type_id, key))
+        resource = CacheRecord.loads(_first(cache.get_many(cls.PREFIX_ID.format(key),
+                                                           cls.PREFIX_NAME.format(type_id, key))))
         if resource is None:
-            resource = Resource.get_by_id(key) or Resource.get_by(name=key,
-                                                                  resource_type_id=type_id,
-                                                                  to_dict=False,
-                                                                  first=True)
-        if resource is not None:
-            cls.set(resource)
+            resource = _get_by_id_or(Resource, key, db.and_(Resource.name == str(key),
+                                                            Resource.resource_type_id == type_id))
+            resource = resource and cls.set(resource)
 
         return resource
 
+    @classmethod
+    @use_master
+    def get_many(cls, ids):
+        """
+        :return: {resource_id: resource or None}
+        """
+        ids = list(set(ids))
+        if not ids:
+            return dict()
+
+        values = cache.get_many(*[cls.PREFIX_ID.format(_id) for _id in ids])
+        id2resource = {_id: CacheRecord.loads(value) for _id, value in zip(ids, values)}
+        missing = [_id for _id, resource in id2resource.items() if resource is None]
+        if missing:
+            mapping = dict()
+            for resource in Resource.get_by(__func_in___key_id=missing, to_dict=False):
+                value = CacheRecord.dumps(resource)
+                mapping[cls.PREFIX_ID.format(resource.id)] = value
+                mapping[cls.PREFIX_NAME.format(resource.resource_type_id, resource.name)] = value
+                id2resource[resource.id] = CacheRecord.loads(value)
+            mapping and cache.set_many(mapping)
+
+        return id2resource
+
     @classmethod
     def set(cls, resource):
-        cache.set(cls.PREFIX_ID.format(resource.id), resource)
-        cache.set(cls.PREFIX_NAME.format(resource.resource_type_id, resource.name), resource)
+        value = CacheRecord.dumps(resource)
+        cache.set_many({cls.PREFIX_ID.format(resource.id): value,
+                        cls.PREFIX_NAME.format(resource.resource_type_id, resource.name): value})
+
+        return CacheRecord.loads(value)
 
     @classmethod
     def clean(cls, resource):
@@ -295,28 +1172,101 @@ class ResourceCache(object):
 
 
 class ResourceGroupCache(object):
-    PREFIX_ID = "ResourceGroup::id::{0}"
-    PREFIX_NAME = "ResourceGroup::type_id::{0}::name::{1}"
+    PREFIX_ID = CacheRecord.versioned("ResourceGroup::id::{0}")
+    PREFIX_NAME = CacheRecord.versioned("ResourceGroup::type_id::{0}::name::{1}")
 
     @classmethod
+    @use_master
     def get(cls, key, type_id=None):
-        group = cache.get(cls.PREFIX_ID.format(key)) or cache.get(cls.PREFIX_NAME.format(type_id, key))
+        group = CacheRecord.loads(_first(cache.get_many(cls.PREFIX_ID.format(key),
+                                                        cls.PREFIX_NAME.format(type_id, key))))
         if group is None:
             group = ResourceGroup.get_by_id(key) or ResourceGroup.get_by(name=key,
                                                                          resource_type_id=type_id,
                                                                          to_dict=False,
                                                                          first=True)
-        if group is not None:
-            cls.set(group)
+            group = group and cls.set(group)
 
         return group
 
     @classmethod
     def set(cls, group):
-        cache.set(cls.PREFIX_ID.format(group.id), group)
-        cache.set(cls.PREFIX_NAME.format(group.resource_type_id, group.name), group)
+        value = CacheRecord.dumps(group)
+        cache.set_many({cls.PREFIX_ID.format(group.id): value,
+                        cls.PREFIX_NAME.format(group.resource_type_id, group.name): value})
+
+        return CacheRecord.loads(value)
 
     @classmethod
     def clean(cls, group):
         cache.delete(cls.PREFIX_ID.format(group.id))
         cache.delete(cls.PREFIX_NAME.format(group.resource_type_id, group.name))
+
+
+class ResourceGroupItemsCache(object):
+    """
+    two-way membership index: group -> resource ids and resource -> group ids
+    """
+    PREFIX_GROUP = "ResourceGroupItems::group_id::{0}"
+    PREFIX_RESOURCE = "ResourceGroupItems::resource_id::{0}"
+
+    @classmethod
+    @use_master
+    def _get_many(cls, prefix, ids, key_col, value_col):
+        namespace = prefix.split("::{0}")[0]
+        result, missing = dict(), []
+        for _id in set(int(i) for i in ids):
+            value = LocalCache.get(namespace, _id)
+            if value is None:
+                missing.append(_id)
+            else:
+                result[_id] = value
+
+        if not missing:
+            return result
+
+        values = cache.get_many(*[prefix.format(_id) for _id in missing])
+        not_cached = [_id for _id, value in zip(missing, values) if value is None]
+        result.update({_id: value for _id, value in zip(missing, values) if value is not None})
+        if not_cached:
+            fetched = {_id: [] for _id in not_cached}
+            for item in ResourceGroupItems.get_by(to_dict=False, **{"__func_in___key_{0}".format(key_col): not_cached}):
+                fetched[getattr(item, key_col)].append(getattr(item, value_col))
+            cache.set_many({prefix.format(_id): value for _id, value in fetched.items()}, timeout=0)
+            result.update(fetched)
+
+        for _id in missing:
+            LocalCache.set(namespace, _id, result[_id])
+
+        return result
+
+    @classmethod
+    def get_resource_ids_many(cls, group_ids):
+        """
+        :return: {group_id: [resource_id, ]}
+        """
+        return cls._get_many(cls.PREFIX_GROUP, group_ids, "group_id", "resource_id")
+
+    @classmethod
+    def get_group_ids_many(cls, resource_ids):
+        """
+        :return: {resource_id: [group_id, ]}
+        """
+        return cls._get_many(cls.PREFIX_RESOURCE, resource_ids, "resource_id", "group_id")
+
+    @classmethod
+    def get_resource_ids(cls, group_id):
+        return cls.get_resource_ids_many([group_id])[int(group_id)]
+
+    @classmethod
+    def get_group_ids(cls, resource_id):
+        return cls.get_group_ids_many([resource_id])[int(resource_id)]
+
+    @classmethod
+    def clean(cls, group_ids=None, resource_ids=None):
+        keys = [cls.PREFIX_GROUP.format(int(i)) for i in group_ids or []]
+        keys += [cls.PREFIX_RESOURCE.format(int(i)) for i in resource_ids or []]
+        keys and cache.delete_many(*keys)
+
+        group_ids and LocalCache.bump(cls.PREFIX_GROUP.split("::{0}")[0])
+        resource_ids and LocalCache.bump(cls.PREFIX_RESOURCE.split("::{0}")[0])
@@ -1,14 +1,14 @@
 # -*- coding:utf-8 -*-
-import datetime
 
 from flask import abort
 
-from api.extensions import db
+from api.lib.db_session import use_master
 from api.lib.perm.acl.audit import AuditCRUD
 from api.lib.perm.acl.audit import AuditOperateSource
 from api.lib.perm.acl.audit import AuditOperateType
 from api.lib.perm.acl.cache import PermissionCache
 from api.lib.perm.acl.cache import RoleCache
+from api.lib.perm.acl.cache import RoleRelationCache
 from api.lib.perm.acl.cache import UserCache
 from api.lib.perm.acl.const import ACL_QUEUE
 from api.lib.perm.acl.resp_format import ErrFormat
@@ -17,10 +17,20 @@ from api.models.acl import Resource
 from api.models.acl import ResourceGroup
 from api.models.acl import ResourceType
 from api.models.acl import RolePermission
-from api.tasks.acl import role_rebuild
+from api.tasks.acl import role_rebuild_delta
 
 
 class PermissionCRUD(object):
+    @staticmethod
+    def _rebuild_delta(rid, app_id, changes, grant=True):
+        """
+        :param changes: [(resource_id, group_id, [perm, ]), ]
+        """
+        changes = [[resource_id, group_id, list(perms)] for resource_id, group_id, perms in changes if perms]
+        if changes:
+            role_rebuild_delta.apply_async(args=(rid, app_id, RoleRelationCache.get_version(rid, app_id),
+                                                 changes, grant), queue=ACL_QUEUE)
+
     @staticmethod
     def get_all(resource_id=None, group_id=None, need_users=True):
         result = dict()
@@ -38,8 +48,8 @@ class PermissionCRUD(object):
             rt_id = rg.resource_type_id
             perms = RolePermission.get_by(group_id=group_id, to_dict=False)
 
-        rid2obj = dict()
-        uid2obj = dict()
+        rid2obj = RoleCache.get_many([perm.rid for perm in perms])
+        uid2obj = UserCache.get_many([role.uid for role in rid2obj.values() if role and role.uid])
         for perm in perms:
             perm_dict = PermissionCache.get(perm.perm_id, rt_id)
             perm_dict = perm_dict and perm_dict.to_dict()
@@ -79,226 +89,146 @@ class PermissionCRUD(object):
         return r and cls.get_all(r.id)
 
     @staticmethod
-    def grant(rid, perms, resource_id=None, group_id=None, rebuild=True, source=AuditOperateSource.acl):
-        app_id = None
-        rt_id = None
-
+    @use_master
+    def _apply(rid, perms, targets, key="resource_id", perm_map=None, grant=True, rebuild=True,
+               source=AuditOperateSource.acl):
+        """
+        grant or revoke as set operations: one query for the existing tuples, one bulk write
+        and one audit row per app and resource type
+        :param targets: Resource or ResourceGroup objects, key is their RolePermission column
+        :param perm_map: {str(target id): [perm, ]}, replaces perms per target
+        """
         from api.lib.perm.acl.resource import ResourceTypeCRUD
 
-        if resource_id is not None:
-            from api.models.acl import Resource
+        type2targets = dict()
+        for target in targets:
+            type2targets.setdefault((target.app_id, target.resource_type_id), []).append(target)
+
+        for (app_id, rt_id), _targets in type2targets.items():
+            if not perms and not isinstance(perm_map, dict):
+                _perms = [i.get('name') for i in ResourceTypeCRUD.get_perms(rt_id)]
+            else:
+                _perms = perms
+
+            wanted = dict()
+            for target in _targets:
+                names = (perm_map.get(str(target.id)) or []) if isinstance(perm_map, dict) else _perms
+                for name in set(names):
+                    perm = PermissionCache.get(name, rt_id)
+                    if perm:
+                        wanted.setdefault(target.id, dict())[perm.id] = perm.name
+            if not wanted:
+                continue
+
+            existed = RolePermission.get_by(rid=rid,
+                                            app_id=app_id,
+                                            __func_in___key_perm_id=list({j for i in wanted.values() for j in i}),
+                                            to_dict=False,
+                                            **{"__func_in___key_{}".format(key): list(wanted)})
+            existed = [i for i in existed if i.perm_id in wanted.get(getattr(i, key), {})]
+
+            if grant:
+                existed = {(getattr(i, key), i.perm_id) for i in existed}
+                rows = [{"rid": rid, "app_id": app_id, "perm_id": perm_id, key: target_id}
+                        for target_id in wanted for perm_id in wanted[target_id]
+                        if (target_id, perm_id) not in existed]
+                RolePermission.bulk_create(rows)
+                # unsaved, the audit log only reads their resource, group and perm ids
+                role_permissions = [RolePermission(**row) for row in rows]
+            else:
+                role_permissions = existed
+                RolePermission.bulk_soft_delete([i.id for i in role_permissions])
+
+            if rebuild:
+                PermissionCRUD._rebuild_delta(
+                    rid, app_id, [(target_id, None, names.values()) if key == "resource_id" else
+                                  (None, target_id, names.values()) for target_id, names in wanted.items()],
+                    grant=grant)
+
+            AuditCRUD.add_permission_log(app_id, AuditOperateType.grant if grant else AuditOperateType.revoke,
+                                         rid, rt_id, role_permissions, source=source)
 
+    @staticmethod
+    def _get_target(resource_id=None, group_id=None):
+        """
+        :return: ([resource or group], RolePermission column)
+        """
+        if resource_id is not None:
             resource = Resource.get_by_id(resource_id) or abort(404, ErrFormat.resource_not_found.format(
                 "id={}".format(resource_id)))
 
-            app_id = resource.app_id
-            rt_id = resource.resource_type_id
-            if not perms:
-                perms = [i.get('name') for i in ResourceTypeCRUD.get_perms(resource.resource_type_id)]
+            return [resource], "resource_id"
 
         elif group_id is not None:
-            from api.models.acl import ResourceGroup
-
             group = ResourceGroup.get_by_id(group_id) or abort(
                 404, ErrFormat.resource_group_not_found.format("id={}".format(group_id)))
-            app_id = group.app_id
-            rt_id = group.resource_type_id
-            if not perms:
-                perms = [i.get('name') for i in ResourceTypeCRUD.get_perms(group.resource_type_id)]
 
-        _role_permissions = []
+            return [group], "group_id"
 
-        for _perm in set(perms):
-            perm = PermissionCache.get(_perm, rt_id)
-            if not perm:
-                continue
+        return [], "resource_id"
 
-            existed = RolePermission.get_by(rid=rid,
-                                            app_id=app_id,
-                                            perm_id=perm.id,
-                                            group_id=group_id,
-                                            resource_id=resource_id)
+    @staticmethod
+    def _get_targets(resource_ids=None, group_ids=None):
+        """
+        one query per kind, aborts with 404 on the first missing id
+        :return: [([resources or groups], RolePermission column), ]
+        """
+        result = []
+        for ids, model, key, err in ((resource_ids, Resource, "resource_id", ErrFormat.resource_not_found),
+                                     (group_ids, ResourceGroup, "group_id", ErrFormat.resource_group_not_found)):
+            ids = {int(i) for i in ids or []}
+            if not ids:
+                continue
 
-            if not existed:
-                __role_permission = RolePermission.create(rid=rid,
-                                                          app_id=app_id,
-                                                          perm_id=perm.id,
-                                                          group_id=group_id,
-                                                          resource_id=resource_id)
-                _role_permissions.append(__role_permission)
+            targets = model.get_by(__func_in___key_id=list(ids), to_dict=False)
+            for _id in ids - {i.id for i in targets}:
+                return abort(404, err.format("id={}".format(_id)))
 
-        if rebuild:
-            role_rebuild.apply_async(args=(rid, app_id), queue=ACL_QUEUE)
+            result.append((targets, key))
 
-        AuditCRUD.add_permission_log(app_id, AuditOperateType.grant, rid, rt_id, _role_permissions,
-                                     source=source)
+        return result
 
     @staticmethod
-    def batch_grant_by_resource_names(rid, perms, resource_type_id, resource_names,
-                                      resource_ids=None, perm_map=None, app_id=None):
-
-        from api.lib.perm.acl.resource import ResourceTypeCRUD
-
+    def _get_resources_by_names(resource_type_id, resource_names, resource_ids=None):
         if resource_names:
-            resource_ids = []
-            from api.models.acl import Resource
-
-            for n in resource_names:
-                resource = Resource.get_by(name=n, resource_type_id=resource_type_id, first=True, to_dict=False)
-                if resource:
-                    app_id = resource.app_id
-                    if not perms:
-                        perms = [i.get('name') for i in ResourceTypeCRUD.get_perms(resource.resource_type_id)]
-
-                    resource_ids.append(resource.id)
-        resource_ids = resource_ids or []
-
-        _role_permissions = []
-        if isinstance(perm_map, dict):
-            perm2resource = dict()
-            for resource_id in resource_ids:
-                for _perm in (perm_map.get(str(resource_id)) or []):
-                    perm2resource.setdefault(_perm, []).append(resource_id)
-            for _perm in perm2resource:
-                perm = PermissionCache.get(_perm, resource_type_id)
-                existeds = RolePermission.get_by(rid=rid,
-                                                 app_id=app_id,
-                                                 perm_id=perm.id,
-                                                 __func_in___key_resource_id=perm2resource[_perm],
-                                                 to_dict=False)
-
-                for resource_id in (set(perm2resource[_perm]) - set([i.resource_id for i in existeds])):
-                    _role_permission = RolePermission.create(flush=False,
-                                                             commit=False,
-                                                             rid=rid,
-                                                             app_id=app_id,
-                                                             perm_id=perm.id,
-                                                             resource_id=resource_id,
-                                                             )
-                    _role_permissions.append(_role_permission)
-
-            db.session.commit()
-
-        else:
-            for _perm in perms:
-                perm = PermissionCache.get(_perm, resource_type_id)
-                for resource_id in resource_ids:
-                    existed = RolePermission.get_by(rid=rid,
-                                                    app_id=app_id,
-                                                    perm_id=perm.id,
-                                                    resource_id=resource_id)
-
-                    if not existed:
-                        _role_permission = RolePermission.create(rid=rid,
-                                                                 app_id=app_id,
-                                                                 perm_id=perm.id,
-                                                                 resource_id=resource_id)
-                        _role_permissions.append(_role_permission)
+            return Resource.get_by(__func_in___key_name=list(set(resource_names)),
+                                   resource_type_id=resource_type_id,
+                                   to_dict=False)
 
-        role_rebuild.apply_async(args=(rid, app_id), queue=ACL_QUEUE)
-
-        AuditCRUD.add_permission_log(app_id, AuditOperateType.grant, rid, resource_type_id, _role_permissions)
+        return resource_ids and Resource.get_by(__func_in___key_id=list(set(resource_ids)), to_dict=False) or []
 
     @staticmethod
-    def revoke(rid, perms, resource_id=None, group_id=None, rebuild=True, source=AuditOperateSource.acl):
-        app_id = None
-        rt_id = None
-
-        from api.lib.perm.acl.resource import ResourceTypeCRUD
-        if resource_id is not None:
-            from api.models.acl import Resource
+    def grant(rid, perms, resource_id=None, group_id=None, rebuild=True, source=AuditOperateSource.acl):
+        targets, key = PermissionCRUD._get_target(resource_id, group_id)
 
-            resource = Resource.get_by_id(resource_id) or abort(
-                404, ErrFormat.resource_not_found.format("id={}".format(resource_id)))
-            app_id = resource.app_id
-            rt_id = resource.resource_type_id
-            if not perms:
-                perms = [i.get('name') for i in ResourceTypeCRUD.get_perms(resource.resource_type_id)]
+        PermissionCRUD._apply(rid, perms, targets, key, rebuild=rebuild, source=source)
 
-        elif group_id is not None:
-            from api.models.acl import ResourceGroup
+    @staticmethod
+    def batch_grant(rid, perms, resource_ids=None, group_ids=None, rebuild=True, source=AuditOperateSource.acl):
+        for targets, key in PermissionCRUD._get_targets(resource_ids, group_ids):
+            PermissionCRUD._apply(rid, perms, targets, key, rebuild=rebuild, source=source)
 
-            group = ResourceGroup.get_by_id(group_id) or abort(
-                404, ErrFormat.resource_group_not_found.format("id={}".format(group_id)))
-            app_id = group.app_id
+    @staticmethod
+    def batch_grant_by_resource_names(rid, perms, resource_type_id, resource_names,
+                                      resource_ids=None, perm_map=None, app_id=None):
+        resources = PermissionCRUD._get_resources_by_names(resource_type_id, resource_names, resource_ids)
 
-            rt_id = group.resource_type_id
-            if not perms:
-                perms = [i.get('name') for i in ResourceTypeCRUD.get_perms(group.resource_type_id)]
-        _role_permissions = []
+        PermissionCRUD._apply(rid, perms, resources, perm_map=perm_map)
 
-        for perm in perms:
-            perm = PermissionCache.get(perm, rt_id)
-            if not perm:
-                continue
-            existed = RolePermission.get_by(rid=rid,
-                                            perm_id=perm.id,
-                                            group_id=group_id,
-                                            resource_id=resource_id,
-                                            first=True,
-                                            to_dict=False)
-            if existed:
-                existed.soft_delete()
-                _role_permissions.append(existed)
+    @staticmethod
+    def revoke(rid, perms, resource_id=None, group_id=None, rebuild=True, source=AuditOperateSource.acl):
+        targets, key = PermissionCRUD._get_target(resource_id, group_id)
 
-        if rebuild:
-            role_rebuild.apply_async(args=(rid, app_id), queue=ACL_QUEUE)
+        PermissionCRUD._apply(rid, perms, targets, key, grant=False, rebuild=rebuild, source=source)
 
-        AuditCRUD.add_permission_log(app_id, AuditOperateType.revoke, rid, rt_id, _role_permissions,
-                                     source=source)
+    @staticmethod
+    def batch_revoke(rid, perms, resource_ids=None, group_ids=None, rebuild=True, source=AuditOperateSource.acl):
+        for targets, key in PermissionCRUD._get_targets(resource_ids, group_ids):
+            PermissionCRUD._apply(rid, perms, targets, key, grant=False, rebuild=rebuild, source=source)
 
     @staticmethod
     def batch_revoke_by_resource_names(rid, perms, resource_type_id, resource_names,
                                        resource_ids=None, perm_map=None, app_id=None):
+        resources = PermissionCRUD._get_resources_by_names(resource_type_id, resource_names, resource_ids)
 
-        from api.lib.perm.acl.resource import ResourceTypeCRUD
-        if resource_names:
-            resource_ids = []
-            from api.models.acl import Resource
-
-            for n in resource_names:
-                resource = Resource.get_by(name=n, resource_type_id=resource_type_id, first=True, to_dict=False)
-                if resource:
-                    app_id = resource.app_id
-                    if not perms:
-                        perms = [i.get('name') for i in ResourceTypeCRUD.get_perms(resource.resource_type_id)]
-
-                    resource_ids.append(resource.id)
-        resource_ids = resource_ids or []
-
-        _role_permissions = []
-        if isinstance(perm_map, dict):
-            perm2resource = dict()
-            for resource_id in resource_ids:
-                for _perm in (perm_map.get(str(resource_id)) or []):
-                    perm2resource.setdefault(_perm, []).append(resource_id)
-            for _perm in perm2resource:
-                perm = PermissionCache.get(_perm, resource_type_id)
-                existeds = RolePermission.get_by(rid=rid,
-                                                 app_id=app_id,
-                                                 perm_id=perm.id,
-                                                 __func_in___key_resource_id=perm2resource[_perm],
-                                                 to_dict=False)
-                for existed in existeds:
-                    existed.deleted = True
-                    existed.deleted_at = datetime.datetime.now()
-                    db.session.add(existed)
-                    _role_permissions.append(existed)
-
-            db.session.commit()
-        else:
-            for _perm in perms:
-                perm = PermissionCache.get(_perm, resource_type_id)
-                for resource_id in resource_ids:
-                    existed = RolePermission.get_by(rid=rid,
-                                                    app_id=app_id,
-                                                    perm_id=perm.id,
-                                                    resource_id=resource_id,
-                                                    first=True, to_dict=False)
-                    if existed:
-                        existed.soft_delete()
-                        _role_permissions.append(existed)
-
-        role_rebuild.apply_async(args=(rid, app_id), queue=ACL_QUEUE)
-
-        AuditCRUD.add_permission_log(app_id, AuditOperateType.revoke, rid, resource_type_id, _role_permissions)
+        PermissionCRUD._apply(rid, perms, resources, perm_map=perm_map, grant=False)
@@ -5,11 +5,15 @@ from flask import abort
 from flask import current_app
 
 from api.extensions import db
+from api.lib.db_session import use_master
 from api.lib.perm.acl.audit import AuditCRUD
 from api.lib.perm.acl.audit import AuditOperateType
 from api.lib.perm.acl.audit import AuditScope
 from api.lib.perm.acl.cache import ResourceCache
 from api.lib.perm.acl.cache import ResourceGroupCache
+from api.lib.perm.acl.cache import ResourceGroupItemsCache
+from api.lib.perm.acl.cache import RoleEffectivePermCache
+from api.lib.perm.acl.cache import RoleRelationCache
 from api.lib.perm.acl.cache import UserCache
 from api.lib.perm.acl.const import ACL_QUEUE
 from api.lib.perm.acl.resp_format import ErrFormat
@@ -20,7 +24,7 @@ from api.models.acl import ResourceGroup
 from api.models.acl import ResourceGroupItems
 from api.models.acl import ResourceType
 from api.models.acl import RolePermission
-from api.tasks.acl import role_rebuild
+from api.tasks.acl import schedule_role_rebuild
 from api.tasks.acl import update_resource_to_build_role
 
 
@@ -121,24 +125,19 @@ class ResourceTypeCRUD(object):
                                    )
 
     @classmethod
+    @use_master
     def update_perms(cls, rt_id, perms, app_id):
         existed = Permission.get_by(resource_type_id=rt_id, to_dict=False)
         existed_names = [i.name for i in existed]
         existed_ids = [i.id for i in existed]
         current_ids = []
 
-        for i in existed:
-            if i.name not in perms:
-                i.soft_delete()
-            else:
-                current_ids.append(i.id)
+        Permission.bulk_soft_delete([i.id for i in existed if i.name not in perms], commit=False)
+        current_ids.extend(i.id for i in existed if i.name in perms)
 
-        for i in perms:
-            if i not in existed_names:
-                p = Permission.create(resource_type_id=rt_id,
-                                      name=i,
-                                      app_id=app_id)
-                current_ids.append(p.id)
+        created = Permission.bulk_create([dict(resource_type_id=rt_id, name=i, app_id=app_id)
+                                          for i in perms if i not in existed_names], with_ids=True)
+        current_ids.extend(i.id for i in created)
 
         return existed_ids, current_ids
 
@@ -161,9 +160,10 @@ class ResourceGroupCRUD(object):
 
     @staticmethod
     def get_items(rg_id):
-        items = ResourceGroupItems.get_by(group_id=rg_id, to_dict=False)
+        resource_ids = ResourceGroupItemsCache.get_resource_ids(rg_id)
+        id2resource = ResourceCache.get_many(resource_ids)
 
-        return [i.resource.to_dict() for i in items]
+        return [id2resource[_id].to_dict() for _id in resource_ids if id2resource.get(_id) is not None]
 
     @staticmethod
     def add(name, type_id, app_id, uid=None):
@@ -183,13 +183,14 @@ class ResourceGroupCRUD(object):
         existed = ResourceGroupItems.get_by(group_id=rg_id, to_dict=False)
         existed_ids = [i.resource_id for i in existed]
 
-        for i in existed:
-            if i.resource_id not in items:
-                i.soft_delete()
+        ResourceGroupItems.bulk_soft_delete([i.id for i in existed if i.resource_id not in items], commit=False)
+        ResourceGroupItems.bulk_create([dict(group_id=rg_id, resource_id=_id)
+                                        for _id in items if _id not in existed_ids])
+
+        ResourceGroupItemsCache.clean([rg_id], existed_ids + list(items))
 
-        for _id in items:
-            if _id not in existed_ids:
-                ResourceGroupItems.create(group_id=rg_id, resource_id=_id)
+        for rid in set(i.rid for i in RolePermission.get_by(group_id=rg_id, to_dict=False)):
+            RoleEffectivePermCache.clean(RoleRelationCache.get_descendant_ids(rid, rg.app_id), rg.app_id)
 
         AuditCRUD.add_resource_log(rg.app_id, AuditOperateType.update,
                                    AuditScope.resource_group, rg.id, rg.to_dict(), rg.to_dict(),
@@ -202,24 +203,21 @@ class ResourceGroupCRUD(object):
             404, ErrFormat.resource_group_not_found.format("id={}".format(rg_id)))
 
         origin = rg.to_dict()
-        rg.soft_delete()
 
         items = ResourceGroupItems.get_by(group_id=rg_id, to_dict=False)
-        existed_ids = []
+        existed_ids = [i.resource_id for i in items]
+        ResourceGroupItems.bulk_soft_delete([i.id for i in items], commit=False)
 
-        for item in items:
-            existed_ids.append(item.resource_id)
-            item.soft_delete()
+        role_permissions = RolePermission.get_by(group_id=rg_id, to_dict=False)
+        rebuild = set(i.rid for i in role_permissions)
+        RolePermission.bulk_soft_delete([i.id for i in role_permissions], commit=False)
 
-        rebuild = set()
-        for i in RolePermission.get_by(group_id=rg_id, to_dict=False):
-            i.soft_delete()
-            rebuild.add(i.rid)
+        rg.soft_delete()
 
-        for _rid in rebuild:
-            role_rebuild.apply_async(args=(_rid, rg.app_id), queue=ACL_QUEUE)
+        schedule_role_rebuild(rebuild, rg.app_id)
 
         ResourceGroupCache.clean(rg)
+        ResourceGroupItemsCache.clean([rg_id], existed_ids)
 
         AuditCRUD.add_resource_log(rg.app_id, AuditOperateType.delete,
                                    AuditScope.resource_group, rg.id, origin, {},
@@ -316,14 +314,14 @@ class ResourceCRUD(object):
         resource.soft_delete()
 
         ResourceCache.clean(resource)
+        ResourceGroupItemsCache.clean(ResourceGroupItemsCache.get_group_ids(_id), [_id])
 
-        rebuilds = []
-        for i in RolePermission.get_by(resource_id=_id, to_dict=False):
-            i.soft_delete()
-            rebuilds.append((i.rid, i.app_id))
+        role_permissions = RolePermission.get_by(resource_id=_id, to_dict=False)
+        rebuilds = [(i.rid, i.app_id) for i in role_permissions]
+        RolePermission.bulk_soft_delete([i.id for i in role_permissions])
 
         for rid, app_id in set(rebuilds):
-            role_rebuild.apply_async(args=(rid, app_id), queue=ACL_QUEUE)
+            schedule_role_rebuild(rid, app_id)
 
         AuditCRUD.add_resource_log(resource.app_id, AuditOperateType.delete,
                                    AuditScope.resource, resource.id, origin, {}, {})
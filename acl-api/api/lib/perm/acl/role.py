@@ -1,33 +1,36 @@
 # -*- coding:utf-8 -*-
 
 
-import time
-
 import six
 from flask import abort
 from flask import current_app
 from sqlalchemy import or_
 
 from api.extensions import db
+from api.lib.db_session import use_master
 from api.lib.perm.acl.app import AppCRUD
 from api.lib.perm.acl.audit import AuditCRUD, AuditOperateType, AuditScope
+from api.lib.perm.acl.cache import AppAdminRoleCache
 from api.lib.perm.acl.cache import AppCache
+from api.lib.perm.acl.cache import AuthIdentityCache
+from api.lib.perm.acl.cache import CredentialCache
 from api.lib.perm.acl.cache import HasResourceRoleCache
+from api.lib.perm.acl.cache import ResourceCache
+from api.lib.perm.acl.cache import ResourceGroupItemsCache
 from api.lib.perm.acl.cache import RoleCache
+from api.lib.perm.acl.cache import RoleEffectivePermCache
 from api.lib.perm.acl.cache import RoleRelationCache
 from api.lib.perm.acl.cache import UserCache
 from api.lib.perm.acl.const import ACL_QUEUE
 from api.lib.perm.acl.const import OperateType
-from api.lib.perm.acl.resource import ResourceGroupCRUD
 from api.lib.perm.acl.resp_format import ErrFormat
 from api.models.acl import Resource, ResourceGroup
-from api.models.acl import ResourceGroupItems
 from api.models.acl import ResourceType
 from api.models.acl import Role
 from api.models.acl import RolePermission
 from api.models.acl import RoleRelation
 from api.tasks.acl import op_record
-from api.tasks.acl import role_rebuild
+from api.tasks.acl import schedule_role_rebuild
 
 
 class RoleRelationCRUD(object):
@@ -69,46 +72,33 @@ class RoleRelationCRUD(object):
     @staticmethod
     def get_parent_ids(rid, app_id):
         if app_id is not None:
-            return [i.parent_id for i in RoleRelation.get_by(child_id=rid, app_id=app_id, to_dict=False)] + \
-                   [i.parent_id for i in RoleRelation.get_by(child_id=rid, app_id=None, to_dict=False)]
+            return RoleRelation.get_by(child_id=rid, app_id=app_id, fl='parent_id', to_tuple=True) + \
+                   RoleRelation.get_by(child_id=rid, app_id=None, fl='parent_id', to_tuple=True)
         else:
-            return [i.parent_id for i in RoleRelation.get_by(child_id=rid, app_id=app_id, to_dict=False)]
+            return RoleRelation.get_by(child_id=rid, app_id=app_id, fl='parent_id', to_tuple=True)
 
     @staticmethod
     def get_child_ids(rid, app_id):
         if app_id is not None:
-            return [i.child_id for i in RoleRelation.get_by(parent_id=rid, app_id=app_id, to_dict=False)] + \
-                   [i.child_id for i in RoleRelation.get_by(parent_id=rid, app_id=None, to_dict=False)]
+            return RoleRelation.get_by(parent_id=rid, app_id=app_id, fl='child_id', to_tuple=True) + \
+                   RoleRelation.get_by(parent_id=rid, app_id=None, fl='child_id', to_tuple=True)
         else:
-            return [i.child_id for i in RoleRelation.get_by(parent_id=rid, app_id=app_id, to_dict=False)]
-
-    @classmethod
-    def recursive_parent_ids(cls, rid, app_id):
-        all_parent_ids = set()
+            return RoleRelation.get_by(parent_id=rid, app_id=app_id, fl='child_id', to_tuple=True)
 
-        def _get_parent(_id):
-            all_parent_ids.add(_id)
-            parent_ids = RoleRelationCache.get_parent_ids(_id, app_id)
-            for parent_id in parent_ids:
-                _get_parent(parent_id)
+    @staticmethod
+    def _closure_app_ids(app_id):
+        if app_id is not None:
+            return [app_id]
 
-        _get_parent(rid)
+        return [None] + [app.id for app in AppCRUD.get_all()]
 
-        return all_parent_ids
+    @classmethod
+    def recursive_parent_ids(cls, rid, app_id):
+        return RoleRelationCache.get_ancestor_ids(rid, app_id)
 
     @classmethod
     def recursive_child_ids(cls, rid, app_id):
-        all_child_ids = set()
-
-        def _get_children(_id):
-            all_child_ids.add(_id)
-            child_ids = RoleRelationCache.get_child_ids(_id, app_id)
-            for child_id in child_ids:
-                _get_children(child_id)
-
-        _get_children(rid)
-
-        return all_child_ids
+        return RoleRelationCache.get_descendant_ids(rid, app_id)
 
     @classmethod
     def get_users_by_rid(cls, rid, app_id, rid2obj=None, uid2obj=None):
@@ -117,15 +107,12 @@ class RoleRelationCRUD(object):
 
         users = []
         rids = cls.recursive_child_ids(rid, app_id)
+        rid2obj.update(RoleCache.get_many([i for i in rids if i not in rid2obj]))
+        uid2obj.update(UserCache.get_many([rid2obj[i].uid for i in rids
+                                           if rid2obj[i] and rid2obj[i].uid and rid2obj[i].uid not in uid2obj]))
         for rid in rids:
-            if rid not in rid2obj:
-                rid2obj[rid] = RoleCache.get(rid)
-
             role = rid2obj[rid]
             if role and role.uid:
-                if role.uid and role.uid not in uid2obj:
-                    uid2obj[role.uid] = UserCache.get(role.uid)
-
                 u = uid2obj.get(role.uid)
                 u = u and u.to_dict()
                 if u:
@@ -140,6 +127,7 @@ class RoleRelationCRUD(object):
         return users
 
     @classmethod
+    @use_master
     def add(cls, role, parent_id, child_ids, app_id):
         result = []
         for child_id in child_ids:
@@ -150,7 +138,7 @@ class RoleRelationCRUD(object):
             RoleRelationCache.clean(parent_id, app_id)
             RoleRelationCache.clean(child_id, app_id)
 
-            if parent_id in cls.recursive_child_ids(child_id, app_id):
+            if int(parent_id) in cls.recursive_child_ids(child_id, app_id):
                 return abort(400, ErrFormat.inheritance_dead_loop)
 
             if app_id is None:
@@ -160,6 +148,11 @@ class RoleRelationCRUD(object):
 
             result.append(RoleRelation.create(parent_id=parent_id, child_id=child_id, app_id=app_id).to_dict())
 
+            for _app_id in cls._closure_app_ids(app_id):
+                RoleRelationCache.add_closure(parent_id, child_id, _app_id)
+
+        result and AuthIdentityCache.bump()
+
         AuditCRUD.add_role_log(app_id, AuditOperateType.role_relation_add,
                                AuditScope.role_relation, role.id, {}, {},
                                {'child_ids': list(child_ids), 'parent_ids': [parent_id], }
@@ -167,19 +160,26 @@ class RoleRelationCRUD(object):
         return result
 
     @classmethod
+    @use_master
     def delete(cls, _id, app_id):
         existed = RoleRelation.get_by_id(_id) or abort(
             400, ErrFormat.role_relation_not_found.format("id={}".format(_id)))
 
         child_ids = cls.recursive_child_ids(existed.child_id, app_id)
-        for child_id in child_ids:
-            role_rebuild.apply_async(args=(child_id, app_id), queue=ACL_QUEUE)
+        schedule_role_rebuild(child_ids, app_id)
         role = RoleCache.get(existed.parent_id)
 
+        closures = [(_app_id,
+                     cls.recursive_parent_ids(existed.parent_id, _app_id),
+                     cls.recursive_child_ids(existed.child_id, _app_id)) for _app_id in cls._closure_app_ids(app_id)]
+
         existed.soft_delete()
 
         RoleRelationCache.clean(existed.parent_id, app_id)
         RoleRelationCache.clean(existed.child_id, app_id)
+        for _app_id, ancestor_ids, descendant_ids in closures:
+            RoleRelationCache.clean_closure(ancestor_ids, descendant_ids, _app_id)
+        AuthIdentityCache.bump()
 
         AuditCRUD.add_role_log(app_id, AuditOperateType.role_relation_delete,
                                AuditScope.role_relation, role.id, {}, {},
@@ -187,20 +187,27 @@ class RoleRelationCRUD(object):
                                )
 
     @classmethod
+    @use_master
     def delete2(cls, parent_id, child_id, app_id):
         existed = RoleRelation.get_by(parent_id=parent_id, child_id=child_id, app_id=app_id, first=True, to_dict=False)
         existed or abort(400, ErrFormat.role_relation_not_found.format("{} -> {}".format(parent_id, child_id)))
 
         role = RoleCache.get(existed.parent_id)
 
+        closures = [(_app_id,
+                     cls.recursive_parent_ids(existed.parent_id, _app_id),
+                     cls.recursive_child_ids(existed.child_id, _app_id)) for _app_id in cls._closure_app_ids(app_id)]
+
         existed.soft_delete()
 
         child_ids = cls.recursive_child_ids(existed.child_id, app_id)
-        for child_id in child_ids:
-            role_rebuild.apply_async(args=(child_id, app_id), queue=ACL_QUEUE)
+        schedule_role_rebuild(child_ids, app_id)
 
         RoleRelationCache.clean(existed.parent_id, app_id)
         RoleRelationCache.clean(existed.child_id, app_id)
+        for _app_id, ancestor_ids, descendant_ids in closures:
+            RoleRelationCache.clean_closure(ancestor_ids, descendant_ids, _app_id)
+        AuthIdentityCache.bump()
 
         AuditCRUD.add_role_log(app_id, AuditOperateType.role_relation_delete,
                                AuditScope.role_relation, role.id, {}, {},
@@ -254,6 +261,9 @@ class RoleCRUD(object):
                            secret=secret,
                            uid=uid)
 
+        CredentialCache.set(role.key, "role", role.id)
+        role.is_app_admin and AppAdminRoleCache.clean(app_id)
+
         AuditCRUD.add_role_log(app_id, AuditOperateType.create,
                                AuditScope.role, role.id, {}, role.to_dict(), {})
 
@@ -268,9 +278,13 @@ class RoleCRUD(object):
         origin = role.to_dict()
 
         RoleCache.clean(rid)
+        AuthIdentityCache.bump()
 
         role = role.update(**kwargs)
 
+        if origin['is_app_admin'] or role.is_app_admin:
+            AppAdminRoleCache.clean(origin['app_id'], role.app_id)
+
         if origin['uid'] and kwargs.get('name') and kwargs.get('name') != origin['name']:
             from api.models.acl import User
             user = User.get_by(uid=origin['uid'], first=True, to_dict=False)
@@ -291,6 +305,7 @@ class RoleCRUD(object):
         return role
 
     @classmethod
+    @use_master
     def delete_role(cls, rid, force=False):
         from api.lib.perm.acl.acl import is_admin
 
@@ -302,29 +317,33 @@ class RoleCRUD(object):
 
         origin = role.to_dict()
 
-        child_ids = []
-        parent_ids = []
         recursive_child_ids = list(RoleRelationCRUD.recursive_child_ids(rid, role.app_id))
+        closures = [(_app_id,
+                     RoleRelationCRUD.recursive_parent_ids(rid, _app_id),
+                     RoleRelationCRUD.recursive_child_ids(rid, _app_id))
+                    for _app_id in RoleRelationCRUD._closure_app_ids(None)]
 
-        for i in RoleRelation.get_by(parent_id=rid, to_dict=False):
-            child_ids.append(i.child_id)
-            i.soft_delete()
-
-        for i in RoleRelation.get_by(child_id=rid, to_dict=False):
-            parent_ids.append(i.parent_id)
-            i.soft_delete()
+        relations = RoleRelation.get_by(parent_id=rid, to_dict=False)
+        child_ids = [i.child_id for i in relations]
+        parent_relations = RoleRelation.get_by(child_id=rid, to_dict=False)
+        parent_ids = [i.parent_id for i in parent_relations]
+        RoleRelation.bulk_soft_delete([i.id for i in relations + parent_relations], commit=False)
 
-        role_permissions = []
-        for i in RolePermission.get_by(rid=rid, to_dict=False):
-            role_permissions.append(i.to_dict())
-            i.soft_delete()
+        role_permissions = RolePermission.get_by(rid=rid, to_dict=False)
+        RolePermission.bulk_soft_delete([i.id for i in role_permissions], commit=False)
+        role_permissions = [i.to_dict() for i in role_permissions]
 
         role.soft_delete()
 
-        role_rebuild.apply_async(args=(recursive_child_ids, role.app_id), queue=ACL_QUEUE)
+        schedule_role_rebuild(recursive_child_ids, role.app_id)
 
         RoleCache.clean(rid)
         RoleRelationCache.clean(rid, role.app_id)
+        role.is_app_admin and AppAdminRoleCache.clean(role.app_id)
+        CredentialCache.clean(role.key)
+        for _app_id, ancestor_ids, descendant_ids in closures:
+            RoleRelationCache.clean_closure(ancestor_ids, descendant_ids, _app_id)
+        AuthIdentityCache.bump()
 
         AuditCRUD.add_role_log(role.app_id, AuditOperateType.delete,
                                AuditScope.role, role.id, origin, {},
@@ -344,58 +363,64 @@ class RoleCRUD(object):
 
         return id2perms
 
-    @staticmethod
-    def _extend_resources(rid, resource_type_id, app_id):
-        res = RoleRelationCache.get_resources2(rid, app_id)
-        resources = {_id: res['resources'][_id] for _id in res['resources']
-                     if not resource_type_id or resource_type_id == res['resources'][_id]['resource_type_id']}
-        groups = {_id: res['groups'][_id] for _id in res['groups']
-                  if not resource_type_id or resource_type_id == res['groups'][_id]['resource_type_id']}
-
-        return resources, groups
-
     @classmethod
     def recursive_resources(cls, rid, app_id, resource_type_id=None, group_flat=True, to_record=False):
-        def _merge(a, b):
-            for i in b:
-                if i in a:
-                    a[i]['permissions'] = list(set(a[i]['permissions'] + b[i]['permissions']))
-                else:
-                    a[i] = b[i]
-
-            return a
-
         try:
             resource_type_id = resource_type_id and int(resource_type_id)
         except ValueError:
             resource_type = ResourceType.get_by(name=resource_type_id, app_id=app_id, first=True, to_dict=False)
             resource_type_id = resource_type and resource_type.id
 
-        result = dict(resources=dict(), groups=dict())
-        s = time.time()
-        parent_ids = RoleRelationCRUD.recursive_parent_ids(rid, app_id)
-        current_app.logger.info('parent ids {0}: {1}'.format(parent_ids, time.time() - s))
-        for parent_id in parent_ids:
+        perms = []
+
+        def _mask(names):
+            mask = 0
+            for name in names:
+                if name not in perms:
+                    perms.append(name)
+                mask |= 1 << perms.index(name)
+
+            return mask
+
+        def _names(mask):
+            return [name for i, name in enumerate(perms) if mask & (1 << i)]
 
-            _resources, _groups = cls._extend_resources(parent_id, resource_type_id, app_id)
-            current_app.logger.info('middle1: {0}'.format(time.time() - s))
-            _merge(result['resources'], _resources)
-            current_app.logger.info('middle2: {0}'.format(time.time() - s))
-            current_app.logger.info(len(_groups))
-            if not group_flat:
-                _merge(result['groups'], _groups)
-            else:
-                for rg_id in _groups:
-                    items = ResourceGroupCRUD.get_items(rg_id)
-                    for item in items:
-                        if not resource_type_id or resource_type_id == item['resource_type_id']:
-                            item.setdefault('permissions', [])
-                            item['permissions'] = list(set(item['permissions'] + _groups[rg_id]['permissions']))
-                            result['resources'][item['id']] = item
-        current_app.logger.info('End: {0}'.format(time.time() - s))
-
-        result['resources'] = list(result['resources'].values())
-        result['groups'] = list(result['groups'].values())
+        def _type_ok(obj):
+            return not resource_type_id or resource_type_id == obj['resource_type_id']
+
+        id2mask, id2resource = dict(), dict()
+        group2mask, group2obj = dict(), dict()
+        parent_ids = RoleRelationCRUD.recursive_parent_ids(rid, app_id)
+        for res in RoleRelationCache.get_resources2_many(parent_ids, app_id).values():
+            for _id, resource in res['resources'].items():
+                if _type_ok(resource):
+                    id2mask[_id] = id2mask.get(_id, 0) | _mask(resource['permissions'])
+                    id2resource.setdefault(_id, resource)
+            for _id, group in res['groups'].items():
+                if _type_ok(group):
+                    group2mask[_id] = group2mask.get(_id, 0) | _mask(group['permissions'])
+                    group2obj.setdefault(_id, group)
+
+        if group_flat and group2mask:
+            group2items = ResourceGroupItemsCache.get_resource_ids_many(group2mask)
+            missing = set(_id for ids in group2items.values() for _id in ids) - set(id2resource)
+            for _id, resource in ResourceCache.get_many(missing).items():
+                if resource is not None:
+                    id2resource[_id] = resource.to_dict()
+            for group_id, resource_ids in group2items.items():
+                for _id in resource_ids:
+                    resource = id2resource.get(_id)
+                    if resource is not None and _type_ok(resource):
+                        id2mask[_id] = id2mask.get(_id, 0) | group2mask[group_id]
+            group2mask = dict()
+
+        result = dict(resources=[], groups=[])
+        for _id, mask in id2mask.items():
+            id2resource[_id]['permissions'] = _names(mask)
+            result['resources'].append(id2resource[_id])
+        for _id, mask in group2mask.items():
+            group2obj[_id]['permissions'] = _names(mask)
+            result['groups'].append(group2obj[_id])
 
         if to_record:
             op_record.apply_async(args=(app_id, rid, OperateType.READ, ["resources"]),
@@ -409,7 +434,7 @@ class RoleCRUD(object):
 
     @staticmethod
     def get_group_ids(resource_id):
-        return [i.group_id for i in ResourceGroupItems.get_by(resource_id=resource_id, to_dict=False)]
+        return ResourceGroupItemsCache.get_group_ids(resource_id)
 
     @classmethod
     def has_permission(cls, rid, resource_name, resource_type_name, app_id, perm, resource_id=None):
@@ -422,21 +447,61 @@ class RoleCRUD(object):
             resource = resource or abort(403, ErrFormat.resource_not_found.format(resource_name))
             resource_id = resource.id
 
-        parent_ids = RoleRelationCRUD.recursive_parent_ids(rid, app_id)
-        group_ids = cls.get_group_ids(resource_id)
-        for parent_id in parent_ids:
-            id2perms = RoleRelationCache.get_resources(parent_id, app_id)
-            current_app.logger.debug(id2perms)
-            perms = id2perms['id2perms'].get(resource_id, [])
-            if perms and {perm}.issubset(set(perms)):
-                return True
+        return RoleEffectivePermCache.has_permission(rid, app_id, resource_id, perm)
 
-            for group_id in group_ids:
-                perms = id2perms['group2perms'].get(group_id, [])
-                if perms and {perm}.issubset(set(perms)):
-                    return True
+    @classmethod
+    def has_permissions_bulk(cls, rid, app_id, resources):
+        """
+        :param resources: [{resource_name: xx, resource_type_name: xx, perm: xx}, ]
+        :return: {resource_type_name: {resource_name: {perm: bool}}}
+        """
+        result = dict()
+        for i in resources:
+            result.setdefault(i['resource_type_name'], {}).setdefault(i['resource_name'], {})[i['perm']] = False
+
+        type2id = {i.name: i.id for i in ResourceType.get_by(app_id=app_id,
+                                                             __func_in___key_name=list(result),
+                                                             to_dict=False)}
+        names = list(set(i['resource_name'] for i in resources))
+        key2id = {(i.resource_type_id, i.name): i.id
+                  for i in Resource.get_by(__func_in___key_name=names,
+                                           __func_in___key_resource_type_id=list(type2id.values()),
+                                           to_dict=False)} if type2id else {}
+
+        resource_perms = []
+        for i in resources:
+            resource_id = key2id.get((type2id.get(i['resource_type_name']), i['resource_name']))
+            if resource_id is not None:
+                resource_perms.append((i['resource_type_name'], i['resource_name'], resource_id, i['perm']))
+
+        if resource_perms:
+            has_perms = RoleEffectivePermCache.has_permissions(rid, app_id, [i[2:] for i in resource_perms])
+            for (type_name, name, _, perm), has_perm in zip(resource_perms, has_perms):
+                result[type_name][name][perm] = has_perm
 
-        return False
+        return result
+
+    @staticmethod
+    def get_perm_snapshot(rid, app_id):
+        """
+        compact copy of the effective permissions of a role, evaluated by remote clients
+        :return: {rid: xx, app_id: xx, seq: xx, perms: [perm, ],
+                  resources: {resource_type_name: {resource_name: bitmask}}}
+        """
+        seq = RoleEffectivePermCache.get_seq()
+
+        perms, id2mask = RoleEffectivePermCache.get_all(rid, app_id)
+        id2resource = ResourceCache.get_many([_id for _id, mask in id2mask.items() if mask])
+        type_ids = set(i.resource_type_id for i in id2resource.values() if i is not None)
+        type2name = {i.id: i.name for i in ResourceType.get_by(__func_in___key_id=list(type_ids),
+                                                               to_dict=False)} if type_ids else {}
+
+        resources = dict()
+        for _id, resource in id2resource.items():
+            if resource is not None and resource.resource_type_id in type2name:
+                resources.setdefault(type2name[resource.resource_type_id], {})[resource.name] = id2mask[_id]
+
+        return dict(rid=rid, app_id=app_id, seq=seq, perms=perms, resources=resources)
 
     @classmethod
     def get_permissions(cls, rid, resource_name, app_id):
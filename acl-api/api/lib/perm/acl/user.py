@@ -12,6 +12,8 @@ from api.extensions import db
 from api.lib.perm.acl.audit import AuditCRUD
 from api.lib.perm.acl.audit import AuditOperateType
 from api.lib.perm.acl.audit import AuditScope
+from api.lib.perm.acl.cache import AuthIdentityCache
+from api.lib.perm.acl.cache import CredentialCache
 from api.lib.perm.acl.cache import UserCache
 from api.lib.perm.acl.resp_format import ErrFormat
 from api.lib.perm.acl.role import RoleCRUD
@@ -58,6 +60,7 @@ class UserCRUD(object):
 
         kwargs['employee_id'] = '{0:04d}'.format(biggest_employee_id + 1)
         user = User.create(**kwargs)
+        CredentialCache.set(user.key, "user", user.uid)
 
         role = RoleCRUD.add_role(user.username, uid=user.uid)
         AuditCRUD.add_role_log(None, AuditOperateType.create,
@@ -89,6 +92,8 @@ class UserCRUD(object):
             if role is not None:
                 RoleCRUD.update_role(role.id, **dict(name=kwargs['username']))
 
+        AuthIdentityCache.clean(key=user.key, sub=user.email)
+
         user = user.update(**kwargs)
 
         AuditCRUD.add_role_log(None, AuditOperateType.update,
@@ -100,7 +105,10 @@ class UserCRUD(object):
     @classmethod
     def reset_key_secret(cls):
         key, secret = cls.gen_key_secret()
+        AuthIdentityCache.clean(key=current_user.key)
+        CredentialCache.clean(current_user.key)
         current_user.update(key=key, secret=secret)
+        CredentialCache.set(key, "user", current_user.uid)
 
         UserCache.clean(current_user)
 
@@ -113,6 +121,8 @@ class UserCRUD(object):
 
         origin = user.to_dict()
 
+        AuthIdentityCache.clean(key=user.key, sub=user.email)
+        CredentialCache.clean(user.key)
         user.delete()
 
         UserCache.clean(user)
@@ -2,6 +2,7 @@
 
 from __future__ import unicode_literals
 
+import hashlib
 from functools import wraps
 
 import jwt
@@ -12,32 +13,90 @@ from flask import session
 from flask_login import login_user
 
 from api.lib.perm.acl.acl import ACLManager
+from api.lib.perm.acl.acl import AuthContext
 from api.lib.perm.acl.acl import is_app_admin
+from api.lib.perm.acl.acl import session_acl_from_user_info
+from api.lib.perm.acl.cache import AppAccessTokenCache
 from api.lib.perm.acl.cache import AppCache
+from api.lib.perm.acl.cache import AuthIdentityCache
+from api.lib.perm.acl.cache import CredentialCache
+from api.lib.perm.acl.cache import RoleCache
 from api.lib.perm.acl.cache import UserCache
 from api.lib.perm.acl.resp_format import ErrFormat
-from api.models.acl import Role
 from api.models.acl import User
 
 
-def reset_session(user, role=None):
-    from api.lib.perm.acl.acl import ACLManager
-    if role is not None:
-        user_info = ACLManager.get_user_info(role)
+def _once_per_request(func):
+    """
+    an authentication method runs at most once per request, later calls reuse its result
+    """
+
+    @wraps(func)
+    def wrapper():
+        results = AuthContext.get().results
+        if func.__name__ not in results:
+            results[func.__name__] = func()
+
+        return results[func.__name__]
+
+    return wrapper
+
+
+def reset_session(user, role=None, user_info=None):
+    """
+    without user_info the role graph walk is deferred until get_session_acl() is first called
+    """
+    AuthContext.reset_identity()
+    if user_info is not None:
+        session["acl"] = session_acl_from_user_info(user_info, user.avatar if user else user_info.get("avatar"))
+        session["uid"] = user_info.get("uuid")
+        return
+
+    session["acl"] = dict(lazy=role if role is not None else user.username)
+    if user is not None and role is None:
+        session["acl"]["userName"] = user.username
+    if user is not None:
+        session["acl"]["avatar"] = user.avatar
+    session.pop("uid", None)
+
+
+def _load_key_identity(key):
+    principal = CredentialCache.get(key)
+    if principal is None:
+        return
+
+    principal_type, _id = principal
+    if principal_type == "user":
+        user = UserCache.get(_id)
+        if user is not None and user.key == key and not user.block:
+            return dict(username=user.username, role=None, secret=user.secret)
     else:
-        user_info = ACLManager.get_user_info(user.username)
+        role = RoleCache.get(_id)
+        if role is not None and role.key == key:
+            return dict(username=None, role=role.name, secret=role.secret)
+
+
+def _load_sub_identity(sub):
+    user = User.query.filter_by(email=sub).first()
+    if user is not None:
+        return dict(username=user.username, role=None, secret=None)
 
-    session["acl"] = dict(uid=user_info.get("uid"),
-                          avatar=user.avatar if user else user_info.get("avatar"),
-                          userId=user_info.get("uid"),
-                          userName=user_info.get("username"),
-                          nickName=user_info.get("nickname"),
-                          parentRoles=user_info.get("parents"),
-                          childRoles=user_info.get("children"),
-                          roleName=user_info.get("role"))
-    session["uid"] = user_info.get("uuid")
 
+def _login_identity(identity):
+    user = None
+    if identity['username']:
+        user = UserCache.get(identity['username'])
+        if user is None:
+            return False
+
+        login_user(user)
+
+    reset_session(user, role=identity['role'])
+
+    return True
 
+
+@_once_per_request
 def _auth_with_key():
     key = request.values.get('_key')
     secret = request.values.get('_secret')
@@ -48,28 +107,30 @@ def _auth_with_key():
     keys = sorted(request.values.keys())
     req_args = [str(request.values[k]) for k in keys if k not in ("_key", "_secret") and
                 not isinstance(request.values[k], (dict, list))]
-    user, authenticated = User.query.authenticate_with_key(key, secret, req_args, path)
-    if user and authenticated:
-        login_user(user)
-        reset_session(user)
-        return True
+    identity = AuthIdentityCache.get_by_key(key, lambda: _load_key_identity(key))
+    if not identity or hashlib.sha1('{0}{1}{2}'.format(
+            path, identity['secret'], "".join(req_args)).encode("utf-8")).hexdigest() != secret:
+        return False
 
-    role, authenticated = Role.query.authenticate_with_key(key, secret, req_args, path)
-    if role and authenticated:
-        reset_session(None, role=role.name)
-        return True
-
-    return False
+    return _login_identity(identity)
 
 
+@_once_per_request
 def _auth_with_session():
-    if "acl" in session and "userName" in (session["acl"] or {}):
-        login_user(UserCache.get(session["acl"]["userName"]))
-        return True
+    username = (session.get("acl") or {}).get("userName")
+    if not username:
+        return False
 
-    return False
+    user = UserCache.get(username)
+    if user is None or user.block:
+        return False
+
+    login_user(user)
 
+    return True
 
+
+@_once_per_request
 def _auth_with_token():
     auth_headers = request.headers.get('Access-Token', '').strip()
     if not auth_headers:
@@ -78,13 +139,11 @@ def _auth_with_token():
     try:
         token = auth_headers
         data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
-        user = User.query.filter_by(email=data['sub']).first()
-        if not user:
+        identity = AuthIdentityCache.get_by_sub(data['sub'], lambda: _load_sub_identity(data['sub']))
+        if not identity:
             return False
 
-        login_user(user)
-        reset_session(user)
-        return True
+        return _login_identity(identity)
     except jwt.ExpiredSignatureError:
         return False
     except (jwt.InvalidTokenError, Exception) as e:
@@ -92,6 +151,7 @@ def _auth_with_token():
         return False
 
 
+@_once_per_request
 def _auth_with_ip_white_list():
     if request.url.endswith("acl/users/info"):
         return False
@@ -107,6 +167,7 @@ def _auth_with_ip_white_list():
     return False
 
 
+@_once_per_request
 def _auth_with_app_token():
     if _auth_with_session() or _auth_with_token():
         if not is_app_admin(request.values.get('app_id')) and request.method != "GET":
@@ -121,14 +182,20 @@ def _auth_with_app_token():
     if not auth_headers:
         return False
 
+    token = auth_headers
+    app_id = AppAccessTokenCache.get_app_id(token)
+    if app_id is not None:
+        request.values['app_id'] = app_id
+
+        return True
+
     try:
-        token = auth_headers
         data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
-        current_app.logger.warning(data)
         app = AppCache.get(data['sub'])
         if not app:
             return False
 
+        AppAccessTokenCache.set(token, app, data['exp'])
         request.values['app_id'] = app.id
 
         return True
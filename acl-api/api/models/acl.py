@@ -14,6 +14,8 @@ from api.lib.database import CRUDModel
 from api.lib.database import Model
 from api.lib.database import Model2
 from api.lib.database import SoftDeleteMixin
+from api.lib.password import check_password
+from api.lib.password import make_password
 from api.lib.perm.acl.const import ACL_QUEUE
 from api.lib.perm.acl.const import OperateType
 from api.lib.perm.acl.resp_format import ErrFormat
@@ -84,6 +86,22 @@ class UserQuery(BaseQuery):
 
         return user
 
+    def get_by_key(self, key):
+        """
+        match uid by primary key first, then username, nickname or wx_id in one query, in that order of priority
+        """
+        key = str(key)
+        user = key.isdigit() and self.filter(User.uid == int(key)).first()
+        if user:
+            return copy.deepcopy(user)
+
+        attrs = ['username', 'nickname', 'wx_id']
+        users = self.filter(db.or_(*[getattr(User, attr) == key for attr in attrs])).all()
+        for attr in attrs:
+            for user in users:
+                if getattr(user, attr) == key:
+                    return copy.deepcopy(user)
+
     def get(self, uid):
         user = self.filter(User.uid == uid).first()
 
@@ -103,7 +121,7 @@ class User(CRUDModel, SoftDeleteMixin):
     email = db.Column(db.String(100), unique=True, nullable=False)
     mobile = db.Column(db.String(14), unique=True)
     _password = db.Column("password", db.String(80))
-    key = db.Column(db.String(32), nullable=False)
+    key = db.Column(db.String(32), nullable=False, index=True)
     secret = db.Column(db.String(32), nullable=False)
     date_joined = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime, default=datetime.utcnow)
@@ -132,14 +150,21 @@ class User(CRUDModel, SoftDeleteMixin):
         return self._password
 
     def _set_password(self, password):
-        self._password = hashlib.md5(password.encode('utf-8')).hexdigest()
+        self._password = make_password(password)
 
     password = db.synonym("_password", descriptor=property(_get_password, _set_password))
 
     def check_password(self, password):
-        if self.password is None:
-            return False
-        return self.password == password or self.password == hashlib.md5(password.encode('utf-8')).hexdigest()
+        matched, rehashed = check_password(self.password, password)
+        if matched and rehashed:
+            self.update(_password=rehashed)
+
+            from api.lib.perm.acl.cache import CredentialCache
+            from api.lib.perm.acl.cache import UserCache
+            UserCache.clean(self)
+            CredentialCache.clean(self.key)
+
+        return matched
 
 
 class RoleQuery(BaseQuery):
@@ -180,7 +205,7 @@ class Role(Model):
     app_id = db.Column(db.Integer, db.ForeignKey("acl_apps.id"))
     uid = db.Column(db.Integer)
     _password = db.Column("password", db.String(80))
-    key = db.Column(db.String(32))
+    key = db.Column(db.String(32), index=True)
     secret = db.Column(db.String(32))
 
     def _get_password(self):
@@ -188,18 +213,30 @@ class Role(Model):
 
     def _set_password(self, password):
         if password:
-            self._password = hashlib.md5(password.encode('utf-8')).hexdigest()
+            self._password = make_password(password)
 
     password = db.synonym("_password", descriptor=property(_get_password, _set_password))
 
     def check_password(self, password):
-        if self.password is None:
-            return False
-        return self.password == password or self.password == hashlib.md5(password.encode('utf-8')).hexdigest()
+        matched, rehashed = check_password(self.password, password)
+        if matched and rehashed:
+            self.update(_password=rehashed)
+
+            from api.lib.perm.acl.cache import CredentialCache
+            from api.lib.perm.acl.cache import RoleCache
+            RoleCache.clean(self.id)
+            CredentialCache.clean(self.key)
+
+        return matched
 
 
 class RoleRelation(Model):
     __tablename__ = "acl_role_relations"
+    __table_args__ = (
+        db.Index("ix_acl_role_relations_child_id_app_id_deleted", "child_id", "app_id", "deleted"),
+        db.Index("ix_acl_role_relations_parent_id_app_id_deleted", "parent_id", "app_id", "deleted"),
+        {"extend_existing": True},
+    )
 
     parent_id = db.Column(db.Integer, db.ForeignKey('acl_roles.id'))
     child_id = db.Column(db.Integer, db.ForeignKey('acl_roles.id'))
@@ -228,6 +265,10 @@ class ResourceGroup(Model):
 
 class Resource(Model):
     __tablename__ = "acl_resources"
+    __table_args__ = (
+        db.Index("ix_acl_resources_name_resource_type_id_app_id", "name", "resource_type_id", "app_id"),
+        {"extend_existing": True},
+    )
 
     name = db.Column(db.String(128), nullable=False)
     resource_type_id = db.Column(db.Integer, db.ForeignKey("acl_resource_types.id"))
@@ -258,6 +299,12 @@ class Permission(Model):
 
 class RolePermission(Model):
     __tablename__ = "acl_role_permissions"
+    __table_args__ = (
+        db.Index("ix_acl_role_permissions_rid_app_id", "rid", "app_id"),
+        db.Index("ix_acl_role_permissions_rid_perm_id_resource_id", "rid", "perm_id", "resource_id"),
+        db.Index("ix_acl_role_permissions_rid_perm_id_group_id", "rid", "perm_id", "group_id"),
+        {"extend_existing": True},
+    )
 
     rid = db.Column(db.Integer, db.ForeignKey('acl_roles.id'))
     resource_id = db.Column(db.Integer, db.ForeignKey('acl_resources.id'))
@@ -5,7 +5,9 @@ import sys
 from inspect import getmembers, isclass
 
 import six
+from flask import Response
 from flask import jsonify
+from flask import request
 from flask import send_file
 from flask_restful import Resource
 
@@ -22,6 +24,19 @@ class APIView(Resource):
     def jsonify(*args, **kwargs):
         return jsonify(*args, **kwargs)
 
+    @staticmethod
+    def jsonify_conditional(etag, build):
+        """
+        304 if the client already holds etag, otherwise jsonify(**build()) tagged with etag
+        """
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = jsonify(**build())
+        response.set_etag(etag)
+
+        return response
+
     @staticmethod
     def send_file(*args, **kwargs):
         return send_file(*args, **kwargs)
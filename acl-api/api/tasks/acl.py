@@ -9,13 +9,17 @@ from werkzeug.exceptions import BadRequest
 from werkzeug.exceptions import NotFound
 
 from api.extensions import celery
+from api.lib.db_session import use_master
 from api.lib.decorator import flush_db
 from api.lib.decorator import reconnect_db
 from api.lib.perm.acl.audit import AuditCRUD
 from api.lib.perm.acl.audit import AuditOperateSource
 from api.lib.perm.acl.audit import AuditOperateType
 from api.lib.perm.acl.cache import AppCache
+from api.lib.perm.acl.cache import ResourceGroupItemsCache
 from api.lib.perm.acl.cache import RoleCache
+from api.lib.perm.acl.cache import RoleEffectivePermCache
+from api.lib.perm.acl.cache import RoleRebuildQueue
 from api.lib.perm.acl.cache import RoleRelationCache
 from api.lib.perm.acl.cache import UserCache
 from api.lib.perm.acl.const import ACL_QUEUE
@@ -29,6 +33,7 @@ from api.models.acl import Trigger
              queue=ACL_QUEUE,)
 @flush_db
 @reconnect_db
+@use_master
 def role_rebuild(rids, app_id):
     rids = rids if isinstance(rids, list) else [rids]
     for rid in rids:
@@ -37,25 +42,98 @@ def role_rebuild(rids, app_id):
     current_app.logger.info("Role {0} App {1} rebuild..........".format(rids, app_id))
 
 
+@celery.task(name="acl.role_rebuild_drain",
+             queue=ACL_QUEUE, )
+@flush_db
+@reconnect_db
+@use_master
+def role_rebuild_drain():
+    RoleRebuildQueue.unschedule()
+
+    batch_size = current_app.config.get("ACL_ROLE_REBUILD_BATCH") or 100
+    failed = []
+    items = RoleRebuildQueue.pop(batch_size)
+    while items:
+        rebuilt = []
+        for rid, app_id in items:
+            try:
+                RoleRelationCache.rebuild(rid, app_id)
+                rebuilt.append((rid, app_id))
+            except Exception as e:
+                current_app.logger.error("Role {0} App {1} rebuild error, {2}".format(rid, app_id, str(e)))
+                failed.append((rid, app_id))
+        RoleRebuildQueue.done(rebuilt)
+
+        items = RoleRebuildQueue.pop(batch_size)
+
+    # popped items are gone from the queue, put the failed ones back for the next drain
+    if failed:
+        countdown = current_app.config.get("ACL_ROLE_REBUILD_DEBOUNCE", 1)
+        max_failures = current_app.config.get("ACL_ROLE_REBUILD_MAX_FAILURES") or 5
+        scheduled, dropped = RoleRebuildQueue.retry(failed, countdown, max_failures)
+        for rid, app_id in dropped:
+            current_app.logger.error("Role {0} App {1} rebuild failed {2} times, dropped".format(
+                rid, app_id, max_failures))
+        if scheduled:
+            role_rebuild_drain.apply_async(countdown=countdown, queue=ACL_QUEUE)
+
+    current_app.logger.info("Role rebuild drained: {0}".format(RoleRebuildQueue.stats()))
+
+
+def schedule_role_rebuild(rids, app_id):
+    """
+    rebuilds of the same (rid, app_id) requested within ACL_ROLE_REBUILD_DEBOUNCE seconds run once
+    """
+    rids = list(rids) if isinstance(rids, (list, set, tuple)) else [rids]
+    if not rids:
+        return
+
+    countdown = current_app.config.get("ACL_ROLE_REBUILD_DEBOUNCE", 1)
+    try:
+        if RoleRebuildQueue.add(rids, app_id, countdown):
+            role_rebuild_drain.apply_async(countdown=countdown, queue=ACL_QUEUE)
+    except Exception as e:
+        current_app.logger.error("schedule role rebuild error, {0}".format(str(e)))
+        role_rebuild.apply_async(args=(rids, app_id), queue=ACL_QUEUE)
+
+
+@celery.task(name="acl.role_rebuild_delta",
+             queue=ACL_QUEUE, )
+@flush_db
+@reconnect_db
+@use_master
+def role_rebuild_delta(rid, app_id, version, changes, grant=True):
+    if not RoleRelationCache.apply_delta(rid, app_id, version, changes, grant):
+        schedule_role_rebuild(rid, app_id)
+        current_app.logger.info("Role {0} App {1} version changed, rebuild scheduled".format(rid, app_id))
+
+
 @celery.task(name="acl.update_resource_to_build_role", queue=ACL_QUEUE)
 @reconnect_db
+@use_master
 def update_resource_to_build_role(resource_id, app_id, group_id=None):
-    rids = [i.id for i in Role.get_by(__func_isnot__key_uid=None, fl='id', to_dict=False)]
-    rids += [i.id for i in Role.get_by(app_id=app_id, fl='id', to_dict=False)]
-    rids += [i.id for i in Role.get_by(__func_is___key_uid=None, __func_is___key_app_id=None, fl='id', to_dict=False)]
+    rids = Role.get_by(__func_isnot__key_uid=None, fl='id', to_tuple=True)
+    rids += Role.get_by(app_id=app_id, fl='id', to_tuple=True)
+    rids += Role.get_by(__func_is___key_uid=None, __func_is___key_app_id=None, fl='id', to_tuple=True)
+
+    # the resource is also seen, flattened, by the roles granted one of its groups
+    group_ids = set(ResourceGroupItemsCache.get_group_ids(resource_id)) if resource_id else set()
 
     current_app.logger.info(rids)
     for rid in rids:
-        if resource_id and resource_id in RoleRelationCache.get_resources(rid, app_id).get('id2perms', {}):
+        resources = RoleRelationCache.get_resources(rid, app_id)
+        if (resource_id and resource_id in resources.get('id2perms', {})) or \
+                (group_id and group_id in resources.get('group2perms', {})):
             RoleRelationCache.rebuild2(rid, app_id)
 
-        if group_id and group_id in RoleRelationCache.get_resources(rid, app_id).get('group2perms', {}):
-            RoleRelationCache.rebuild2(rid, app_id)
+        elif group_ids & set(resources.get('group2perms', {})):
+            RoleEffectivePermCache.notify(RoleRelationCache.get_descendant_ids(rid, app_id), app_id)
 
 
 @celery.task(name="acl.apply_trigger", queue=ACL_QUEUE)
 @flush_db
 @reconnect_db
+@use_master
 def apply_trigger(_id, resource_id=None, operator_uid=None):
     from api.lib.perm.acl.permission import PermissionCRUD
 
@@ -101,12 +179,12 @@ def apply_trigger(_id, resource_id=None, operator_uid=None):
 
     perms = json.loads(trigger.permissions)
     roles = json.loads(trigger.roles)
-    for resource in resources:
-        for rid in roles:
-            try:
-                PermissionCRUD.grant(rid, perms, resource.id, rebuild=False, source=AuditOperateSource.trigger)
-            except (NotFound, BadRequest):
-                pass
+    for rid in roles:
+        try:
+            PermissionCRUD.batch_grant(rid, perms, resource_ids=[r.id for r in resources if r],
+                                       rebuild=False, source=AuditOperateSource.trigger)
+        except (NotFound, BadRequest):
+            pass
 
     AuditCRUD.add_trigger_log(trigger.app_id, trigger.id, AuditOperateType.trigger_apply, {}, trigger.to_dict(),
                               {'uid': uid,
@@ -122,6 +200,7 @@ def apply_trigger(_id, resource_id=None, operator_uid=None):
 @celery.task(name="acl.cancel_trigger", queue=ACL_QUEUE)
 @flush_db
 @reconnect_db
+@use_master
 def cancel_trigger(_id, resource_id=None, operator_uid=None):
     from api.lib.perm.acl.permission import PermissionCRUD
 
@@ -167,14 +246,12 @@ def cancel_trigger(_id, resource_id=None, operator_uid=None):
 
     perms = json.loads(trigger.permissions)
     roles = json.loads(trigger.roles)
-    for resource in resources:
-        if not resource:
-            continue
-        for rid in roles:
-            try:
-                PermissionCRUD.revoke(rid, perms, resource.id, rebuild=False, source=AuditOperateSource.trigger)
-            except (NotFound, BadRequest):
-                pass
+    for rid in roles:
+        try:
+            PermissionCRUD.batch_revoke(rid, perms, resource_ids=[r.id for r in resources if r],
+                                        rebuild=False, source=AuditOperateSource.trigger)
+        except (NotFound, BadRequest):
+            pass
 
     AuditCRUD.add_trigger_log(trigger.app_id, trigger.id, AuditOperateType.trigger_cancel, {}, trigger.to_dict(),
                               {'uid': uid,
@@ -90,15 +90,9 @@ class RolePermissionBatchGrantView(APIView):
 
         perms = handle_arg_list(request.values.get("perms"))
 
-        if resource_ids and isinstance(resource_ids, list):
-            for resource_id in resource_ids[:-1]:
-                PermissionCRUD.grant(rid, perms, resource_id=resource_id, group_id=None, rebuild=False)
-            PermissionCRUD.grant(rid, perms, resource_id=resource_ids[-1], group_id=None, rebuild=True)
-
-        if group_ids and isinstance(group_ids, list):
-            for group_id in group_ids[:-1]:
-                PermissionCRUD.grant(rid, perms, resource_id=None, group_id=group_id, rebuild=False)
-            PermissionCRUD.grant(rid, perms, resource_id=None, group_id=group_ids[-1], rebuild=True)
+        PermissionCRUD.batch_grant(rid, perms,
+                                   resource_ids=resource_ids if isinstance(resource_ids, list) else None,
+                                   group_ids=group_ids if isinstance(group_ids, list) else None)
 
         return self.jsonify(rid=rid, resource_ids=resource_ids, group_ids=group_ids, perms=perms)
 
@@ -154,14 +148,8 @@ class RolePermissionBatchRevokeView(APIView):
 
         perms = handle_arg_list(request.values.get("perms"))
 
-        if resource_ids and isinstance(resource_ids, list):
-            for resource_id in resource_ids[:-1]:
-                PermissionCRUD.revoke(rid, perms, resource_id=resource_id, group_id=None, rebuild=False)
-            PermissionCRUD.revoke(rid, perms, resource_id=resource_ids[-1], group_id=None, rebuild=True)
-
-        if group_ids and isinstance(group_ids, list):
-            for group_id in group_ids[:-1]:
-                PermissionCRUD.revoke(rid, perms, resource_id=None, group_id=group_id, rebuild=False)
-            PermissionCRUD.revoke(rid, perms, resource_id=None, group_id=group_ids[-1], rebuild=True)
+        PermissionCRUD.batch_revoke(rid, perms,
+                                    resource_ids=resource_ids if isinstance(resource_ids, list) else None,
+                                    group_ids=group_ids if isinstance(group_ids, list) else None)
 
         return self.jsonify(rid=rid, resource_ids=resource_ids, group_ids=group_ids, perms=perms)
@@ -10,7 +10,9 @@ from api.lib.decorator import args_validate
 from api.lib.perm.acl import validate_app
 from api.lib.perm.acl.acl import is_app_admin
 from api.lib.perm.acl.cache import AppCache
+from api.lib.perm.acl.cache import ETagCache
 from api.lib.perm.acl.cache import RoleCache
+from api.lib.perm.acl.cache import RoleEffectivePermCache
 from api.lib.perm.acl.resp_format import ErrFormat
 from api.lib.perm.acl.role import RoleCRUD
 from api.lib.perm.acl.role import RoleRelationCRUD
@@ -21,6 +23,15 @@ from api.lib.utils import get_page_size
 from api.resource import APIView
 
 
+def _get_app_id(app_id):
+    """
+    app_id may still be an app name when an app admin authenticated by session or token
+    """
+    app = AppCache.get(app_id) or abort(404, ErrFormat.app_not_found.format("id={}".format(app_id)))
+
+    return app.id
+
+
 class RoleView(APIView):
     url_prefix = ("/roles", "/roles/<int:rid>")
 
@@ -140,11 +151,40 @@ class RoleResourcesView(APIView):
     @auth_with_app_token
     @validate_app
     def get(self, rid):
+        app_id = request.values['app_id']
         resource_type_id = request.values.get('resource_type_id')
         group_flat = request.values.get('group_flat', True)
-        res = RoleCRUD.recursive_resources(rid, request.values['app_id'], resource_type_id, group_flat, to_record=True)
+        app = AppCache.get(app_id)  # changes are recorded by app id, app_id may still be a name here
+        etag = ETagCache.make("RoleResources", rid, app_id, resource_type_id, group_flat,
+                              RoleEffectivePermCache.get_version(rid, app and app.id))
+
+        return self.jsonify_conditional(etag, lambda: RoleCRUD.recursive_resources(
+            rid, app_id, resource_type_id, group_flat, to_record=True))
+
+
+class RolePermSnapshotView(APIView):
+    url_prefix = "/roles/<int:rid>/perm_snapshot"
+
+    @auth_with_app_token
+    @validate_app
+    def get(self, rid):
+        return self.jsonify(RoleCRUD.get_perm_snapshot(rid, _get_app_id(request.values['app_id'])))
 
-        return self.jsonify(res)
+
+class RolePermChangesView(APIView):
+    url_prefix = "/roles/perm_changes"
+
+    @auth_with_app_token
+    @validate_app
+    def get(self):
+        try:
+            since = int(request.values.get('since') or 0)
+        except ValueError:
+            return abort(400, ErrFormat.invalid_request)
+
+        seq, rids = RoleEffectivePermCache.changes_since(_get_app_id(request.values['app_id']), since)
+
+        return self.jsonify(seq=seq, rids=rids)
 
 
 class RoleHasPermissionView(APIView):
@@ -172,3 +212,35 @@ class RoleHasPermissionView(APIView):
         result = RoleCRUD.has_permission(role.id, resource_name, resource_type_name, app_id, perm)
 
         return self.jsonify(result=result)
+
+
+class RoleHasPermissionBulkView(APIView):
+    url_prefix = "/roles/has_perms"
+
+    @args_required('resources')
+    @validate_app
+    @auth_with_app_token
+    def post(self):
+        if not request.values.get('rid'):
+            role = RoleCache.get_by_name(None, current_user.username)
+            role or abort(404, ErrFormat.role_not_found.format(current_user.username))
+        else:
+            role = RoleCache.get(int(request.values.get('rid')))
+            role or abort(404, ErrFormat.role_not_found.format("id={}".format(request.values.get('rid'))))
+
+        resources = request.values.get('resources')
+        if not isinstance(resources, list) or not all(
+                isinstance(i, dict) and {'resource_name', 'resource_type_name', 'perm'}.issubset(i) for i in resources):
+            return abort(400, ErrFormat.invalid_request)
+
+        app_id = request.values.get('app_id')
+        if is_app_admin(app_id):
+            result = dict()
+            for i in resources:
+                result.setdefault(i['resource_type_name'], {}).setdefault(i['resource_name'], {})[i['perm']] = True
+
+            return self.jsonify(result=result)
+
+        result = RoleCRUD.has_permissions_bulk(role.id, _get_app_id(app_id), resources)
+
+        return self.jsonify(result=result)
@@ -13,6 +13,8 @@ from api.lib.decorator import args_validate
 from api.lib.perm.acl.acl import ACLManager
 from api.lib.perm.acl.acl import role_required
 from api.lib.perm.acl.cache import AppCache
+from api.lib.perm.acl.cache import AuthIdentityCache
+from api.lib.perm.acl.cache import ETagCache
 from api.lib.perm.acl.cache import UserCache
 from api.lib.perm.acl.resp_format import ErrFormat
 from api.lib.perm.acl.role import RoleRelationCRUD
@@ -36,20 +38,20 @@ class GetUserInfoView(APIView):
 
             name = request.values.get('username')
 
-        current_app.logger.info("get user info for1: app_id: {0}, name: {1}".format(request.values.get('app_id'), name))
-        user_info = ACLManager().get_user_info(name, request.values.get('app_id'))
-        current_app.logger.info("get user info for2: {}".format(user_info))
+        etag = ETagCache.make("UserInfo", name, app_id, AuthIdentityCache.get_version(), UserCache.get_version(name))
 
-        result = dict(name=user_info.get('nickname') or name,
-                      username=user_info.get('username') or name,
-                      email=user_info.get('email'),
-                      uid=user_info.get('uid'),
-                      rid=user_info.get('rid'),
-                      role=dict(permissions=user_info.get('parents')),
-                      avatar=user_info.get('avatar'))
+        def _build():
+            user_info = ACLManager().get_user_info(name, app_id)
 
-        current_app.logger.info("get user info for3: {}".format(result))
-        return self.jsonify(result=result)
+            return dict(result=dict(name=user_info.get('nickname') or name,
+                                    username=user_info.get('username') or name,
+                                    email=user_info.get('email'),
+                                    uid=user_info.get('uid'),
+                                    rid=user_info.get('rid'),
+                                    role=dict(permissions=user_info.get('parents')),
+                                    avatar=user_info.get('avatar')))
+
+        return self.jsonify_conditional(etag, _build)
 
 
 class GetUserKeySecretView(APIView):
@@ -1,17 +1,44 @@
 # -*- coding:utf-8 -*-
 
 import hashlib
+import json
+import threading
+import time
 import traceback
 
 import requests
 from flask import current_app, g, has_request_context
 from flask import session, abort
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from api.extensions import cache
 
 ACL_URI = "http://{xxx}/api/v1"
 APP_ID = "{app id}"
 APP_SECRET_KEY = "{app secret key}"
+PERM_SNAPSHOT = False  # evaluate has_permission locally from per-role snapshots
+PERM_SNAPSHOT_POLL_INTERVAL = 5  # seconds between two polls of the change stream
+HTTP_TIMEOUT = (3, 10)  # connect, read
+
+
+class _HttpSession(requests.Session):
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        return super(_HttpSession, self).request(*args, **kwargs)
+
+
+def _http_session():
+    http_session = _HttpSession()
+    adapter = HTTPAdapter(pool_maxsize=20,
+                          max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=(502, 503, 504)))
+    http_session.mount("http://", adapter)
+    http_session.mount("https://", adapter)
+
+    return http_session
+
+
+http = _http_session()
 
 
 def get_access_token():
@@ -19,7 +46,7 @@ def get_access_token():
     payload = dict(app_id=APP_ID,
                    secret_key=hashlib.md5(APP_SECRET_KEY.encode('utf-8')).hexdigest())
     try:
-        res = requests.post(url, data=payload).json()
+        res = http.post(url, data=payload).json()
         return res.get("token")
     except Exception as e:
         current_app.logger.error(str(e))
@@ -43,6 +70,95 @@ class AccessTokenCache(object):
         cache.clear(cls.TOKEN_KEY)
 
 
+class PermissionSnapshot(object):
+    """
+    in-process copy of the effective permissions of roles, downloaded from /acl/roles/<rid>/perm_snapshot
+    snapshots are dropped when /acl/roles/perm_changes (or the acl::perm_changes redis channel) reports their role
+    """
+    _snapshots = dict()
+    _since = None
+    _polled_at = 0
+    _listening = False
+    _lock = threading.Lock()
+
+    @classmethod
+    def _drop(cls, rids):
+        with cls._lock:
+            for rid in rids:
+                cls._snapshots.pop(int(rid), None)
+
+    @classmethod
+    def _poll(cls, headers):
+        if cls._listening or cls._since is None or time.time() - cls._polled_at < PERM_SNAPSHOT_POLL_INTERVAL:
+            return
+
+        cls._polled_at = time.time()
+        url = '{0}/acl/roles/perm_changes'.format(ACL_URI)
+        try:
+            res = http.get(url, params=dict(since=cls._since), headers=headers).json()
+        except Exception as e:
+            current_app.logger.error(str(e))
+            cls.clear()
+            return
+
+        cls._drop(res.get('rids') or [])
+        with cls._lock:
+            cls._since = res.get('seq', cls._since)
+
+    @classmethod
+    def get(cls, rid, headers):
+        cls._poll(headers)
+
+        snapshot = cls._snapshots.get(int(rid))
+        if snapshot is None:
+            url = '{0}/acl/roles/{1}/perm_snapshot'.format(ACL_URI, rid)
+            snapshot = http.get(url, headers=headers).json()
+            with cls._lock:
+                cls._snapshots[int(rid)] = snapshot
+                cls._since = snapshot['seq'] if cls._since is None else min(cls._since, snapshot['seq'])
+
+        return snapshot
+
+    @classmethod
+    def has_permission(cls, rid, resource_name, resource_type, perm, headers):
+        snapshot = cls.get(rid, headers)
+        perms = snapshot.get('perms') or []
+        mask = (snapshot.get('resources') or {}).get(resource_type, {}).get(resource_name, 0)
+
+        return perm in perms and bool(mask & (1 << perms.index(perm)))
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._snapshots.clear()
+            cls._since = None
+
+    @classmethod
+    def listen(cls, redis_client):
+        """
+        push mode: subscribe to the channel the ACL server publishes to instead of polling
+        """
+
+        def _listen():
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe("acl::perm_changes")
+            cls._listening = True
+            try:
+                for message in pubsub.listen():
+                    cls._drop(json.loads(message['data']).get('rids') or [])
+            except Exception as e:
+                current_app.logger.error(str(e))
+            finally:
+                cls._listening = False
+                cls.clear()
+
+        thread = threading.Thread(target=_listen, name="acl-perm-changes")
+        thread.daemon = True
+        thread.start()
+
+        return thread
+
+
 class ACLManager(object):
     def __init__(self):
         self.access_token = AccessTokenCache.get()
@@ -58,7 +174,7 @@ class ACLManager(object):
         payload = dict(username=username)
 
         try:
-            res = requests.get(url, data=payload, headers=self.headers).json()
+            res = http.get(url, data=payload, headers=self.headers).json()
             if not res.get("result"):
                 return abort(400, res.get("message"))
 
@@ -78,13 +194,20 @@ class ACLManager(object):
 
             rid = session.get('acl', {}).get('rid')
 
+        if PERM_SNAPSHOT:
+            try:
+                return PermissionSnapshot.has_permission(rid, resource_name, resource_type, perm, self.headers)
+            except Exception as e:
+                current_app.logger.error(str(e))
+                return abort(400, f"ACL: has permission failed: {e}")
+
         url = '{0}/acl/roles/has_perm'.format(ACL_URI)
         payload = dict(rid=rid,
                        resource_name=resource_name,
                        resource_type_name=resource_type,
                        perm=perm)
         try:
-            res = requests.get(url, data=payload, headers=self.headers).json()
+            res = http.get(url, data=payload, headers=self.headers).json()
 
             return res.get("result")
         except Exception as e:
@@ -96,7 +219,7 @@ class ACLManager(object):
         payload = dict(q=name, resource_type_id=resource_type)
 
         try:
-            res = requests.get(url, data=payload, headers=self.headers).json()
+            res = http.get(url, data=payload, headers=self.headers).json()
             for r in res.get('resources', []):
                 if r.get('name') == name:
                     return r.get('id')
@@ -114,7 +237,7 @@ class ACLManager(object):
         url = '{0}/acl/roles/{1}/resources'.format(ACL_URI, session.get('acl', {}).get('rid'))
         payload = dict(resource_type_id=resource_type_name)
         try:
-            res = requests.get(url, data=payload, headers=self.headers).json()
+            res = http.get(url, data=payload, headers=self.headers).json()
             return res.get('resources')
         except Exception as e:
             current_app.logger.error(str(e))
@@ -130,7 +253,7 @@ class ACLManager(object):
         url = '{0}/acl/resources'.format(ACL_URI)
         payload = dict(type_id=resource_type_name, name=name, uid=uid or g.user.uid)
         try:
-            res = requests.post(url, data=payload, headers=self.headers).json()
+            res = http.post(url, data=payload, headers=self.headers).json()
             if res.get("id") is None:
                 return abort(400, res.get("message"))
         except Exception as e:
@@ -145,7 +268,7 @@ class ACLManager(object):
         payload = dict(name=new)
 
         try:
-            res = requests.put(url, data=payload, headers=self.headers).json()
+            res = http.put(url, data=payload, headers=self.headers).json()
             if res.get("message") is not None:
                 return abort(400, res.get("message"))
         except Exception as e:
@@ -167,7 +290,7 @@ class ACLManager(object):
                                                              resource_id)
         payload = dict(perms=perms)
         try:
-            res = requests.post(url, json=payload, headers=self.headers).json()
+            res = http.post(url, json=payload, headers=self.headers).json()
             if res.get("rid") is None:
                 return abort(400, res.get("message"))
         except Exception as e:
@@ -189,7 +312,7 @@ class ACLManager(object):
                                                               resource_id)
         payload = dict(perms=perms)
         try:
-            res = requests.post(url, json=payload, headers=self.headers).json()
+            res = http.post(url, json=payload, headers=self.headers).json()
             if res.get("rid") is None:
                 return abort(400, res.get("message"))
         except Exception as e:
@@ -207,7 +330,7 @@ class ACLManager(object):
         url = '{0}/acl/resources/{1}'.format(ACL_URI, resource_id)
         payload = dict()
         try:
-            res = requests.delete(url, data=payload, headers=self.headers).json()
+            res = http.delete(url, data=payload, headers=self.headers).json()
             if res.get("resource_id") is None:
                 return abort(400, res.get("message"))
         except Exception as e:
@@ -220,7 +343,7 @@ class ACLManager(object):
         url = '{}/acl/resources/{}/permissions'.format(ACL_URI, resource_id)
 
         try:
-            return requests.get(url, headers=self.headers).json()
+            return http.get(url, headers=self.headers).json()
         except Exception as e:
             current_app.logger.error(str(e))
             return abort(400, f"ACL: get resource permissions failed: {e}")
@@ -232,7 +355,7 @@ class ACLManager(object):
             params['q'] = q
 
         try:
-            return requests.get(url, params=params, headers=self.headers).json()
+            return http.get(url, params=params, headers=self.headers).json()
         except Exception as e:
             current_app.logger.error(str(e))
             return abort(400, f"ACL: get resource permissions failed: {e}")
@@ -244,7 +367,7 @@ class ACLManager(object):
             params['q'] = q
 
         try:
-            return requests.get(url, params=params, headers=self.headers).json()
+            return http.get(url, params=params, headers=self.headers).json()
         except Exception as e:
             current_app.logger.error(str(e))
             return abort(400, f"ACL: get resource permissions failed: {e}")
@@ -253,7 +376,7 @@ class ACLManager(object):
         url = '{}/acl/roles/{}/users'.format(ACL_URI, rid)
 
         try:
-            return requests.get(url, params=dict(page_size=100000), headers=self.headers).json()
+            return http.get(url, params=dict(page_size=100000), headers=self.headers).json()
         except Exception as e:
             current_app.logger.error(str(e))
             return abort(400, f"ACL: get users by rid failed: {e}")
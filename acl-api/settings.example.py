@@ -15,6 +15,10 @@ ENV = env.str("FLASK_ENV", default="production")
 DEBUG = ENV == "development"
 SECRET_KEY = env.str("SECRET_KEY")
 BCRYPT_LOG_ROUNDS = env.int("BCRYPT_LOG_ROUNDS", default=13)
+# md5 | bcrypt, passwords stored in another format are upgraded on the next successful login
+PASSWORD_HASHER = "bcrypt"
+# in-process cache of slow hash verifications
+PASSWORD_VERIFY_CACHE = dict(maxsize=10000, ttl=60)
 DEBUG_TB_ENABLED = DEBUG
 DEBUG_TB_INTERCEPT_REDIRECTS = False
 
@@ -30,6 +34,13 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_ENGINE_OPTIONS = {
     'pool_recycle': 300,
 }
+# read replicas: keys of SQLALCHEMY_BINDS replicating the primary (None) or another bind, e.g.
+# binds={None: ["replica"], "user": ["user_replica"]}
+SQLALCHEMY_REPLICAS = dict(
+    binds={},
+    max_lag=2,  # seconds, replicas further behind or unreachable are skipped
+    check_interval=5,  # seconds between lag checks of a replica
+)
 
 # # cache
 CACHE_TYPE = "redis"
@@ -38,6 +49,14 @@ CACHE_REDIS_PORT = 6379
 CACHE_KEY_PREFIX = "CMDB::"
 CACHE_DEFAULT_TIMEOUT = 3000
 
+# # per-worker in-process cache in front of redis for App/Role/User/Permission
+ACL_LOCAL_CACHE = dict(
+    enabled=False,
+    maxsize=10000,  # entries
+    ttl=60,  # seconds
+    version_check_interval=1,  # seconds between checks of the invalidation generation in redis
+)
+
 # # log
 LOG_PATH = './logs/app.log'
 LOG_LEVEL = 'DEBUG'
@@ -59,6 +78,17 @@ CELERY = {
     "broker_vhost": "/",
     "broker_connection_retry_on_startup": True
 }
+# seconds a resolved _key/_secret or JWT identity is reused before being reloaded
+ACL_AUTH_IDENTITY_TTL = 300
+# pooled http client used to talk to a remote ACL server (ACL_URI)
+ACL_HTTP = dict(timeout=(3, 10), retries=2, backoff_factor=0.1, pool_connections=10, pool_maxsize=20)
+# seconds a remote token verification result is reused
+ACL_TOKEN_VERIFY_TTL = 60
+# role_rebuild requests for the same (rid, app_id) within the debounce window are coalesced
+ACL_ROLE_REBUILD_DEBOUNCE = 1  # seconds
+ACL_ROLE_REBUILD_BATCH = 100
+# a role whose rebuild fails this many drains in a row is dropped from the queue
+ACL_ROLE_REBUILD_MAX_FAILURES = 5
 ONCE = {
     'backend': 'celery_once.backends.Redis',
     'settings': {
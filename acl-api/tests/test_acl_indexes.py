@@ -0,0 +1,46 @@
+# -*- coding:utf-8 -*-
+
+"""
+the hot ACL lookups must be served by the composite indexes declared on the models
+"""
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy import text
+
+import api.lib.perm.acl  # noqa: F401, the models import back from this package, load it first as the app does
+from api.models.acl import Resource
+from api.models.acl import RolePermission
+from api.models.acl import RoleRelation
+
+
+@pytest.fixture(scope="module")
+def engine():
+    engine = create_engine("sqlite://")
+    for model in (RoleRelation, Resource, RolePermission):
+        model.__table__.create(bind=engine)
+
+    return engine
+
+
+def _plan(engine, sql):
+    with engine.connect() as conn:
+        return " ".join(str(row[-1]) for row in conn.execute(text("EXPLAIN QUERY PLAN " + sql)))
+
+
+@pytest.mark.parametrize("sql, index", [
+    ("SELECT * FROM acl_role_permissions WHERE deleted = 0 AND rid = 1 AND app_id = 2",
+     "ix_acl_role_permissions_rid_app_id"),
+    ("SELECT * FROM acl_role_permissions WHERE deleted = 0 AND rid = 1 AND perm_id = 3 AND resource_id = 4",
+     "ix_acl_role_permissions_rid_perm_id_resource_id"),
+    ("SELECT * FROM acl_role_permissions WHERE deleted = 0 AND rid = 1 AND perm_id = 3 AND group_id = 4",
+     "ix_acl_role_permissions_rid_perm_id_group_id"),
+    ("SELECT * FROM acl_role_relations WHERE deleted = 0 AND child_id = 1 AND app_id = 2",
+     "ix_acl_role_relations_child_id_app_id_deleted"),
+    ("SELECT * FROM acl_role_relations WHERE deleted = 0 AND parent_id = 1 AND app_id = 2",
+     "ix_acl_role_relations_parent_id_app_id_deleted"),
+    ("SELECT * FROM acl_resources WHERE deleted = 0 AND name = 'x' AND resource_type_id = 1 AND app_id = 2",
+     "ix_acl_resources_name_resource_type_id_app_id"),
+])
+def test_hot_lookup_uses_composite_index(engine, sql, index):
+    assert index in _plan(engine, sql)
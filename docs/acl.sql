@@ -398,6 +398,7 @@ CREATE TABLE `acl_resources` (
   KEY `app_id` (`app_id`),
   KEY `ix_acl_resources_deleted` (`deleted`),
   KEY `ix_acl_resources_uid` (`uid`),
+  KEY `ix_acl_resources_name_resource_type_id_app_id` (`name`,`resource_type_id`,`app_id`),
   CONSTRAINT `acl_resources_ibfk_1` FOREIGN KEY (`resource_type_id`) REFERENCES `acl_resource_types` (`id`),
   CONSTRAINT `acl_resources_ibfk_2` FOREIGN KEY (`app_id`) REFERENCES `acl_apps` (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
@@ -437,6 +438,9 @@ CREATE TABLE `acl_role_permissions` (
   KEY `perm_id` (`perm_id`),
   KEY `app_id` (`app_id`),
   KEY `ix_acl_role_permissions_deleted` (`deleted`),
+  KEY `ix_acl_role_permissions_rid_app_id` (`rid`,`app_id`),
+  KEY `ix_acl_role_permissions_rid_perm_id_resource_id` (`rid`,`perm_id`,`resource_id`),
+  KEY `ix_acl_role_permissions_rid_perm_id_group_id` (`rid`,`perm_id`,`group_id`),
   CONSTRAINT `acl_role_permissions_ibfk_1` FOREIGN KEY (`rid`) REFERENCES `acl_roles` (`id`),
   CONSTRAINT `acl_role_permissions_ibfk_2` FOREIGN KEY (`resource_id`) REFERENCES `acl_resources` (`id`),
   CONSTRAINT `acl_role_permissions_ibfk_3` FOREIGN KEY (`group_id`) REFERENCES `acl_resource_groups` (`id`),
@@ -475,6 +479,8 @@ CREATE TABLE `acl_role_relations` (
   KEY `child_id` (`child_id`),
   KEY `app_id` (`app_id`),
   KEY `ix_acl_role_relations_deleted` (`deleted`),
+  KEY `ix_acl_role_relations_child_id_app_id_deleted` (`child_id`,`app_id`,`deleted`),
+  KEY `ix_acl_role_relations_parent_id_app_id_deleted` (`parent_id`,`app_id`,`deleted`),
   CONSTRAINT `acl_role_relations_ibfk_1` FOREIGN KEY (`parent_id`) REFERENCES `acl_roles` (`id`),
   CONSTRAINT `acl_role_relations_ibfk_2` FOREIGN KEY (`child_id`) REFERENCES `acl_roles` (`id`),
   CONSTRAINT `acl_role_relations_ibfk_3` FOREIGN KEY (`app_id`) REFERENCES `acl_apps` (`id`)
@@ -515,6 +521,7 @@ CREATE TABLE `acl_roles` (
   KEY `app_id` (`app_id`),
   KEY `ix_acl_roles_name` (`name`),
   KEY `ix_acl_roles_deleted` (`deleted`),
+  KEY `ix_acl_roles_key` (`key`),
   CONSTRAINT `acl_roles_ibfk_1` FOREIGN KEY (`app_id`) REFERENCES `acl_apps` (`id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=4 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
@@ -773,7 +780,8 @@ CREATE TABLE `users` (
   UNIQUE KEY `username` (`username`),
   UNIQUE KEY `mobile` (`mobile`),
   KEY `ix_users_deleted` (`deleted`),
-  KEY `ix_users_employee_id` (`employee_id`)
+  KEY `ix_users_employee_id` (`employee_id`),
+  KEY `ix_users_key` (`key`)
 ) ENGINE=InnoDB AUTO_INCREMENT=3 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
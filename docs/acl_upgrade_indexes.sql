@@ -0,0 +1,16 @@
+-- Composite indexes for the hot ACL lookups, for databases created before they were added
+-- to docs/acl.sql and the models. Fresh installs from docs/acl.sql already have them.
+--
+-- mysql -u <user> -p <database> < docs/acl_upgrade_indexes.sql
+
+ALTER TABLE `acl_role_permissions`
+  ADD KEY `ix_acl_role_permissions_rid_app_id` (`rid`,`app_id`),
+  ADD KEY `ix_acl_role_permissions_rid_perm_id_resource_id` (`rid`,`perm_id`,`resource_id`),
+  ADD KEY `ix_acl_role_permissions_rid_perm_id_group_id` (`rid`,`perm_id`,`group_id`);
+
+ALTER TABLE `acl_role_relations`
+  ADD KEY `ix_acl_role_relations_child_id_app_id_deleted` (`child_id`,`app_id`,`deleted`),
+  ADD KEY `ix_acl_role_relations_parent_id_app_id_deleted` (`parent_id`,`app_id`,`deleted`);
+
+ALTER TABLE `acl_resources`
+  ADD KEY `ix_acl_resources_name_resource_type_id_app_id` (`name`,`resource_type_id`,`app_id`);